@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# script to benchmark the training throughput of word2vec for different thread counts and corpus reading modes,
+# and of data-parallel training with several processes
+#
+# @see: Bachelor Thesis 'Analyse von Wort-Vektoren deutscher Textkorpora'
+#
+# @example: python benchmark.py samples/133M/ benchmark.tsv -t 1 2 4 8 16
+
+import argparse
+import logging
+import multiprocessing as mp
+import os
+import sys
+
+from parallel import train_parallel
+from results import METRICS, evaluate_model
+from training import (
+    CorpusSentences, PrefetchingCorpusSentences, build_vocab, corpus_files, create_model, join_corpus_files,
+    measure_throughput, supports_corpus_file
+)
+
+
+if __name__ == '__main__':
+    # configuration
+    parser = argparse.ArgumentParser(description='Script for benchmarking the training throughput for thread counts')
+    parser.add_argument('corpora', type=str, help='source folder with preprocessed corpora, ideally a sample of them')
+    parser.add_argument('target', type=str, help='target file name to store the tab separated measurements in')
+    parser.add_argument(
+        '-t', '--threads', type=int, nargs='+', default=[1, 2, 4, 8, mp.cpu_count()], help='thread counts to measure'
+    )
+    parser.add_argument(
+        '--modes', choices=['iterator', 'file', 'parallel'], nargs='+', default=['iterator', 'file'],
+        help='read the corpus with the python sentence iterator, let gensim read the corpus file natively '
+             'and/or train with several processes like parallel.py'
+    )
+    parser.add_argument(
+        '-p', '--processes', type=int, nargs='+', default=[2],
+        help='process counts of parallel mode, sharing the threads'
+    )
+    parser.add_argument(
+        '--sync_words', type=int, default=10000000, help='number of words each replica trains between two averages'
+    )
+    parser.add_argument('--evaluate', action='store_true', help='store and evaluate every measured model')
+    parser.add_argument('--topn', type=int, default=10, help='check the top n result in evaluation')
+    parser.add_argument(
+        '-r', '--readers', type=int, default=0, help='background reader threads of the sentence iterator'
+    )
+    parser.add_argument('-e', '--epochs', type=int, default=1, help='number of training epochs per measurement')
+    parser.add_argument('-s', '--size', type=int, default=100, help='dimension of word vectors')
+    parser.add_argument('-w', '--window', type=int, default=5, help='size of the sliding window')
+    parser.add_argument('-m', '--mincount', type=int, default=5, help='minimum number of occurences of a word')
+    parser.add_argument('-g', '--sg', type=int, default=1, help='training algorithm: Skip-Gram (1), otherwise CBOW (0)')
+    parser.add_argument('-i', '--hs', type=int, default=1, help='use of hierachical sampling for training')
+    parser.add_argument('-n', '--negative', type=int, default=0, help='use of negative sampling for training')
+    parser.add_argument(
+        '-o', '--cbowmean', type=int, default=0, help='for CBOW: use sum (0) or mean (1) to merge context vectors'
+    )
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stdout, format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+    logging.getLogger('gensim').setLevel(logging.WARNING)
+
+    modes = list(args.modes)
+    if 'file' in modes and not supports_corpus_file():
+        logging.warning('installed gensim cannot train from a corpus file, only measuring the sentence iterator')
+        modes.remove('file')
+    threads = sorted(set(args.threads))
+
+    # the vocabulary is built once and shared by all measured models
+    files = corpus_files(args.corpora)
+    base = create_model(args, threads=1)
+    total_words = build_vocab(base, files, CorpusSentences(args.corpora), cache_dir=args.corpora)
+    corpus_file, joined = join_corpus_files(files, args.target + '.corpus') if 'file' in modes else (None, False)
+
+    results = []
+    for mode, processes in [(mode, p) for mode in modes for p in (args.processes if mode == 'parallel' else [1])]:
+        for thread_count in threads:
+            model = create_model(args, threads=max(thread_count // processes, 1))
+            model.reset_from(base)
+            if mode == 'parallel':
+                seconds, words_per_second = train_parallel(
+                    model, files, processes, total_words, args.sync_words, epochs=args.epochs
+                )
+            elif mode == 'file':
+                seconds, words_per_second = measure_throughput(
+                    model, corpus_file=corpus_file, total_words=total_words, epochs=args.epochs
+                )
+            else:
+                if args.readers:
+                    sentences = PrefetchingCorpusSentences(args.corpora, args.readers)
+                else:
+                    sentences = CorpusSentences(args.corpora)
+                seconds, words_per_second = measure_throughput(
+                    model, sentences, total_words=total_words, epochs=args.epochs
+                )
+            logging.info('{} with {} processes and {} threads: {:.0f} words/s'.format(
+                mode, processes, thread_count, words_per_second
+            ))
+            accuracies = {}
+            if args.evaluate:
+                model_file = '{}.{}-{}-{}.model'.format(args.target, mode, processes, thread_count)
+                model.wv.save_word2vec_format(model_file, binary=True)
+                accuracies = evaluate_model(model_file, args.topn)
+            results.append((mode, processes, thread_count, seconds, words_per_second, accuracies))
+    if joined:
+        os.remove(corpus_file)
+
+    # speedup relative to the smallest thread count of the same mode and process count,
+    # and relative to the single process sentence iterator with the same number of threads
+    with open(args.target, 'w') as f:
+        f.write('\t'.join(
+            ['mode', 'processes', 'threads', 'seconds', 'words_per_second', 'speedup', 'iterator_speedup'] + METRICS
+        ) + '\n')
+        for mode, processes, thread_count, seconds, words_per_second, accuracies in results:
+            first = next(result[4] for result in results if result[:2] == (mode, processes))
+            iterator = [result[4] for result in results if result[0] == 'iterator' and result[2] == thread_count]
+            f.write('\t'.join([
+                mode, str(processes), str(thread_count), '{:.1f}'.format(seconds), '{:.0f}'.format(words_per_second),
+                '{:.2f}'.format(words_per_second / first),
+                '{:.2f}'.format(words_per_second / iterator[0]) if iterator else ''
+            ] + [str(accuracies.get(metric, '')) for metric in METRICS]) + '\n')
+    logging.info('stored {} measurements in {}'.format(len(results), args.target))
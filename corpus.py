@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+# names and listing of the files preprocessing.py stores, shared by the scripts reading its corpora
+#
+# @see: Bachelor Thesis 'Analyse von Wort-Vektoren deutscher Textkorpora'
+
+import os
+import re
+
+# files preprocessing.py stores next to a corpus, which are no corpora themselves
+CHECKPOINT_SUFFIX = '.checkpoint'
+TMP_SUFFIX = '.tmp'
+PART_SUFFIX = '.part'
+COUNTS_SUFFIX = '.counts'
+PROFILE_SUFFIX = '.profile.json'
+SKETCH_SUFFIX = '.sketch.json'
+STATS_SUFFIX = '.stats.json'
+IDS_SUFFIX = '.ids'
+IDS_OFFSETS_SUFFIX = '.ids.offsets'
+IDS_VOCAB_SUFFIX = '.ids.vocab'
+SIDECAR_SUFFIXES = (
+    CHECKPOINT_SUFFIX, TMP_SUFFIX, PART_SUFFIX, COUNTS_SUFFIX, PROFILE_SUFFIX, SKETCH_SUFFIX, STATS_SUFFIX,
+    IDS_SUFFIX, IDS_OFFSETS_SUFFIX, IDS_VOCAB_SUFFIX
+)
+# output files of preprocessing.py --shards, which share the sidecar files of their corpus
+SHARD_SUFFIX = '.shard'
+SHARD_PATTERN = re.compile(re.escape(SHARD_SUFFIX) + r'\d+$')
+
+
+def corpus_files(source, ids=False):
+    """
+    Lists the corpus files of the given source.
+
+    :param source: corpus file or directory with corpus files
+    :param ids: list binary token id corpora instead of plain text corpora
+    :return: sorted list of file paths
+    """
+    if not os.path.isdir(source):
+        return [source]
+    if ids:
+        return sorted(os.path.join(source, fname) for fname in os.listdir(source) if fname.endswith(IDS_SUFFIX))
+    return sorted(
+        os.path.join(source, fname) for fname in os.listdir(source) if not fname.endswith(SIDECAR_SUFFIXES)
+    )
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# script to train word embeddings with several word2vec processes on separate corpus shards, which periodically
+# average their weights
+#
+# @see: Bachelor Thesis 'Analyse von Wort-Vektoren deutscher Textkorpora'
+#
+# @example: python parallel.py corpus/ test.model -p 4 -t 8 -s 300 -w 10
+
+import argparse
+import logging
+import math
+import multiprocessing as mp
+import os
+import time
+
+import numpy as np
+
+from training import (
+    CorpusSentences, EpochSegment, build_vocab, corpus_files, create_model, export_vectors, open_corpus,
+    trainable_weights, train_scheduled, training_schedule
+)
+
+
+def assign_files(files, processes):
+    """
+    Distributes the given corpus files over the given number of processes, so that all of them get about the
+    same number of bytes.
+
+    :param files: list of corpus files
+    :param processes: number of processes
+    :return: list of file lists and list of byte counts, one per process
+    """
+    shards = [[] for _ in range(processes)]
+    sizes = [0] * processes
+    for fname in sorted(files, key=os.path.getsize, reverse=True):
+        smallest = sizes.index(min(sizes))
+        shards[smallest].append(fname)
+        sizes[smallest] += os.path.getsize(fname)
+    return [sorted(shard) for shard in shards], sizes
+
+
+def average_weights(weights, shared, processes, index, lock, barrier):
+    """
+    Replaces the weights of a replica by the average of the weights of all replicas.
+
+    :param weights: list of weight arrays of the replica
+    :param shared: list of shared arrays of the same shapes
+    :param processes: number of replicas
+    :param index: number of the replica
+    :param lock: lock for adding to the shared arrays
+    :param barrier: barrier of all replicas
+    :return: None
+    """
+    if index == 0:
+        for total in shared:
+            total.fill(0)
+    barrier.wait()
+    with lock:
+        for array, total in zip(weights, shared):
+            total += array
+    barrier.wait()
+    for array, total in zip(weights, shared):
+        np.multiply(total, 1.0 / processes, out=array)
+    # nobody starts clearing the sums of the next round before all replicas got their average
+    barrier.wait()
+
+
+def train_replica(model, files, words, epochs, rounds, shared, index, processes, lock, barrier):
+    """
+    Trains one replica on its corpus files and averages its weights with the other replicas
+    a given number of times per epoch.
+
+    :param model: gensim Word2Vec model with vocabulary and initial weights shared by all replicas
+    :param files: list of corpus files of the replica
+    :param words: estimated number of words in the corpus files of the replica
+    :param epochs: number of training epochs
+    :param rounds: number of averages per epoch
+    :param shared: list of shared raw arrays to average the weights in
+    :param index: number of the replica
+    :param processes: number of replicas
+    :param lock: lock for adding to the shared arrays
+    :param barrier: barrier of all replicas
+    :return: None
+    """
+    weights = trainable_weights(model)
+    shared = [np.frombuffer(total, dtype=array.dtype).reshape(array.shape) for total, array in zip(shared, weights)]
+    sentences = ShardSentences(files)
+    size = max(int(math.ceil(words / float(rounds))), 1)
+    # the learning rate decays over the given epochs, even if the model is set up for another number
+    schedule = dict(training_schedule(model), epochs=epochs)
+    for epoch in range(epochs):
+        iterator = iter(sentences)
+        trained = 0
+        for step in range(rounds):
+            # the last round of an epoch takes all sentences left, as the word count of the shard is an estimate
+            segment = EpochSegment(iterator, size if step < rounds - 1 else float('inf'))
+            train_scheduled(
+                model, schedule, epoch + step / float(rounds), epoch + (step + 1) / float(rounds), segment,
+                total_words=max(size if step < rounds - 1 else words - trained, 1), epochs=1
+            )
+            trained += segment.words
+            average_weights(weights, shared, processes, index, lock, barrier)
+        logging.info('replica {} finished epoch {} with {} words'.format(index + 1, epoch + 1, trained))
+
+
+def train_parallel(model, files, processes, total_words, sync_words, epochs=None):
+    """
+    Trains the given model with several processes, each training a replica on its own part of the corpus files.
+    The replicas start with the same weights and average them every given number of words.
+
+    :param model: gensim Word2Vec model with vocabulary, its workers are the training threads of each replica
+    :param files: list of corpus files
+    :param processes: number of replicas
+    :param total_words: number of words in the corpus
+    :param sync_words: number of words a replica trains between two averages
+    :param epochs: number of training epochs, defaults to the epochs of the model
+    :return: tuple of seconds and words per second
+    """
+    epochs = epochs or model.iter
+    shards, sizes = assign_files(files, processes)
+    # the words of a shard are estimated from its share of the corpus bytes
+    words = [total_words * size / float(sum(sizes)) for size in sizes]
+    # all replicas average equally often, those with smaller shards train fewer words in between
+    rounds = max(int(math.ceil(max(words) / float(sync_words))), 1)
+    weights = trainable_weights(model)
+    shared = [mp.RawArray(np.ctypeslib.as_ctypes_type(array.dtype), array.size) for array in weights]
+    lock = mp.Lock()
+    barrier = mp.Barrier(processes)
+    workers = [
+        mp.Process(
+            target=train_replica,
+            args=(model, shards[k], words[k], epochs, rounds, shared, k, processes, lock, barrier)
+        )
+        for k in range(processes)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    # a failed replica would leave the others waiting at the barrier forever
+    while any(worker.is_alive() for worker in workers):
+        for worker in workers:
+            worker.join(1)
+            if worker.exitcode:
+                barrier.abort()
+                for other in workers:
+                    other.join()
+                raise RuntimeError('replica {} failed with exit code {}'.format(
+                    workers.index(worker) + 1, worker.exitcode
+                ))
+    seconds = time.perf_counter() - start
+    # after the last average, the shared arrays hold the sum of the weights of all replicas
+    for array, total in zip(weights, shared):
+        np.multiply(np.frombuffer(total, dtype=array.dtype).reshape(array.shape), 1.0 / processes, out=array)
+    return seconds, total_words * epochs / seconds
+
+
+# get corpus sentences of a list of corpus files
+class ShardSentences(object):
+    def __init__(self, files):
+        self.files = files
+
+    def __iter__(self):
+        for fname in self.files:
+            with open_corpus(fname) as fp:
+                for line in fp:
+                    yield line.split()
+
+
+if __name__ == '__main__':
+    # configuration
+    parser = argparse.ArgumentParser(description='Script for training word vector models with several processes')
+    parser.add_argument('corpora', type=str, help='source folder with preprocessed corpora, ideally several shards')
+    parser.add_argument('target', type=str, help='target file name to store model in')
+    parser.add_argument('-p', '--processes', type=int, default=2, help='number of processes training a replica')
+    parser.add_argument(
+        '-t', '--threads', type=int, default=mp.cpu_count(), help='total number of training threads of all processes'
+    )
+    parser.add_argument(
+        '--sync_words', type=int, default=10000000, help='number of words each replica trains between two averages'
+    )
+    parser.add_argument('-s', '--size', type=int, default=100, help='dimension of word vectors')
+    parser.add_argument('-w', '--window', type=int, default=5, help='size of the sliding window')
+    parser.add_argument('-m', '--mincount', type=int, default=5, help='minimum number of occurences of a word')
+    parser.add_argument('-g', '--sg', type=int, default=1, help='training algorithm: Skip-Gram (1), otherwise CBOW (0)')
+    parser.add_argument('-i', '--hs', type=int, default=1, help='use of hierachical sampling for training')
+    parser.add_argument('-n', '--negative', type=int, default=0, help='use of negative sampling for training')
+    parser.add_argument(
+        '-o', '--cbowmean', type=int, default=0, help='for CBOW: use sum (0) or mean (1) to merge context vectors'
+    )
+    parser.add_argument('--vocab_cache', type=str, help='folder to cache the word counts of vocabulary scans in')
+    parser.add_argument(
+        '-e', '--export', type=str, nargs='+', default=[], choices=['vectors', 'normalized', 'vocab'],
+        help='additionally store the vectors, normalized vectors and/or vocabulary like training.py'
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+        filename=args.target.strip() + '.result', format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO
+    )
+
+    files = corpus_files(args.corpora)
+    processes = args.processes
+    if len(files) < processes:
+        logging.warning('only {} corpus files for {} processes, split the corpus with preprocessing.py --shards'.format(
+            len(files), processes
+        ))
+        processes = len(files)
+    # the vocabulary is built once and the replicas start from the same initial weights
+    model = create_model(args, threads=max(args.threads // processes, 1))
+    total_words = build_vocab(model, files, CorpusSentences(args.corpora), cache_dir=args.vocab_cache or args.corpora)
+    logging.info('training {} replicas with {} threads each'.format(processes, model.workers))
+    seconds, words_per_second = train_parallel(model, files, processes, total_words, args.sync_words)
+    logging.info('trained {} epochs in {:.0f} seconds with {:.0f} words/s'.format(
+        model.iter, seconds, words_per_second
+    ))
+
+    # store model
+    model.wv.save_word2vec_format(args.target, binary=True)
+    export_vectors(model, args.target.strip(), args.export)
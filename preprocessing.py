@@ -11,34 +11,49 @@
 #
 # @example: python preprocessing.py test.raw test.corpus -psub
 
-import gensim
-import nltk.data
-from nltk.corpus import stopwords
 import argparse
+import array
+import bz2
+import collections
+import glob
+import hashlib
+import itertools
+import json
+import math
 import os
+import pickle
 import re
+import shutil
 import logging
 import sys
+import threading
+import time
+import zlib
 import multiprocessing as mp
+from multiprocessing.util import Finalize
 
-# configuration
-parser = argparse.ArgumentParser(description='Script for preprocessing public corpora')
-parser.add_argument('raw', type=str, help='source file with raw data for corpus creation')
-parser.add_argument('target', type=str, help='target file name to store corpus in')
-parser.add_argument('-p', '--punctuation', action='store_true', help='remove punctuation tokens')
-parser.add_argument('-s', '--stopwords', action='store_true', help='remove stop word tokens')
-parser.add_argument(
-    '-u', '--umlauts', action='store_true', help='replace german umlauts with their respective digraphs'
+from corpus import (
+    CHECKPOINT_SUFFIX, COUNTS_SUFFIX, IDS_OFFSETS_SUFFIX, IDS_SUFFIX, IDS_VOCAB_SUFFIX, PART_SUFFIX, PROFILE_SUFFIX,
+    SHARD_SUFFIX, SKETCH_SUFFIX, STATS_SUFFIX, TMP_SUFFIX
 )
-parser.add_argument('-b', '--bigram', action='store_true', help='detect and process common bigram phrases')
-parser.add_argument('-t', '--threads', type=int, default=mp.cpu_count(), help='thread count')
-parser.add_argument('--batch_size', type=int, default=32, help='batch size for multiprocessing')
-args = parser.parse_args()
-logging.basicConfig(stream=sys.stdout, format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
-sentence_detector = nltk.data.load('tokenizers/punkt/german.pickle')
+
 punctuation_tokens = ['.', '..', '...', ',', ';', ':', '(', ')', '"', '\'', '[', ']',
                       '{', '}', '?', '!', '-', '–', '+', '*', '--', '\'\'', '``']
 punctuation = '?.!/;:()&+'
+# default phrase scoring parameters of gensim's Phrases, also used by the count-min sketch backend
+phrases_min_count = 5
+phrases_threshold = 10.0
+normalization_pattern = re.compile(r'\w+')
+# state of a worker process, see init_worker()
+args = None
+sentence_detector = None
+word_tokenize = None
+stop_words = None
+word_counts = None
+sentence_count = 0
+sentence_lengths = None
+stage_times = None
+phraser = None
 
 
 def replace_umlauts(text):
@@ -67,59 +82,1131 @@ def process_line(line):
     :return: preprocessed sentence
     """
     # detect sentences
+    start = time.perf_counter()
     sentences = sentence_detector.tokenize(line)
+    start = record_time('sentence detection', start)
     # process each sentence
     for sentence in sentences:
         # replace umlauts
         if args.umlauts:
             sentence = replace_umlauts(sentence)
+            start = record_time('umlauts', start)
         # get word tokens
-        words = nltk.word_tokenize(sentence)
+        words = word_tokenize(sentence)
+        start = record_time('tokenization', start)
         # filter punctuation and stopwords
         if args.punctuation:
             words = [x for x in words if x not in punctuation_tokens]
             words = [re.sub('[{}]'.format(punctuation), '', x) for x in words]
+            # tokens consisting only of punctuation are left empty
+            words = [x for x in words if x]
         if args.stopwords:
             words = [x for x in words if x not in stop_words]
+        start = record_time('filtering', start)
         # write one sentence per line in output file, if sentence has more than 1 word
         if len(words) > 1:
+            count_words(words)
+            record_time('counting', start)
             return '{}\n'.format(' '.join(words))
 
-# get stopwords
-if not args.umlauts:
-    stop_words = stopwords.words('german')
-else:
-    stop_words = [replace_umlauts(token) for token in stopwords.words('german')]
-
-if not os.path.exists(os.path.dirname(args.target)):
-    os.makedirs(os.path.dirname(args.target))
-with open(args.raw, 'r') as infile:
-    # start pre processing with multiple threads
-    pool = mp.Pool(args.threads)
-    values = pool.imap(process_line, infile, chunksize=args.batch_size)
-    with open(args.target, 'w') as outfile:
-        for i, s in enumerate(values):
-            if i and i % 25000 == 0:
-                logging.info('processed {} sentences'.format(i))
-                outfile.flush()
-            if s:
-                outfile.write(s)
-        logging.info('preprocessing of {} sentences finished!'.format(i))
+
+def process_batch(batch):
+    """
+    Pre processes the given batch of lines.
+
+    :param batch: tuple of input offset after the batch and list of lines as str
+    :return: tuple of input offset, number of lines and list of preprocessed sentences as str,
+        either one for the whole batch or one per output shard
+    """
+    offset, lines = batch
+    sentences = filter(None, map(process_line, lines))
+    if args.shards > 1 and args.shard_by == 'hash':
+        parts = [[] for _ in range(args.shards)]
+        for sentence in sentences:
+            parts[zlib.crc32(sentence.encode('utf-8')) % args.shards].append(sentence)
+        return offset, len(lines), [''.join(part) for part in parts]
+    return offset, len(lines), [''.join(sentences)]
+
+
+def init_worker(options, state_file=None, tokenize=False, model=None):
+    """
+    Prepares the state of a new worker process, loading heavy resources only once per worker.
+
+    :param options: parsed command line arguments
+    :param state_file: file name prefix to store the state of this worker under when it exits
+    :param tokenize: load the sentence detector, word tokenizer and stop words
+    :param model: optional gensim Phraser to transform sentences with
+    :return: None
+    """
+    global args, sentence_detector, word_tokenize, stop_words, word_counts, sentence_lengths, stage_times, phraser
+    args = options
+    phraser = model
+    if tokenize:
+        # nltk is only imported by workers that tokenize
+        import nltk.data
+        from nltk.corpus import stopwords
+        sentence_detector = nltk.data.load('tokenizers/punkt/german.pickle')
+        word_tokenize = nltk.word_tokenize
+        if not args.umlauts:
+            stop_words = set(stopwords.words('german'))
+        else:
+            stop_words = set(replace_umlauts(token) for token in stopwords.words('german'))
+    if args.counts or args.stats:
+        word_counts = collections.Counter()
+    if args.stats:
+        sentence_lengths = collections.Counter()
+    if args.profile:
+        stage_times = collections.Counter()
+    if state_file:
+        # the state is handed over to the main process when the worker exits on pool.close()
+        Finalize(None, save_worker_state, args=(state_file,), exitpriority=10)
+
+
+def record_time(stage, start):
+    """
+    Adds the time passed since start to the given stage of the current worker, if profiling is enabled.
+
+    :param stage: name of the stage
+    :param start: start time of the stage as returned by time.perf_counter()
+    :return: current time as start of the next stage
+    """
+    now = time.perf_counter()
+    if stage_times is not None:
+        stage_times[stage] += now - start
+    return now
+
+
+def count_words(words):
+    """
+    Adds the given sentence to the word counts and sentence lengths of the current worker, if enabled.
+
+    :param words: list of word tokens
+    :return: None
+    """
+    global sentence_count
+    if word_counts is not None:
+        word_counts.update(words)
+        sentence_count += 1
+    if sentence_lengths is not None:
+        sentence_lengths[len(words)] += 1
+
+
+def count_range(filename, start, end):
+    """
+    Adds the sentences of a byte range of an already written corpus to the word counts of the current worker.
+
+    :param filename: corpus file
+    :param start: first byte of the range
+    :param end: first byte after the range
+    :return: None
+    """
+    for line in read_shard(filename, start, end):
+        words = line.split()
+        if words:
+            count_words(words)
+
+
+def save_worker_state(state_file):
+    """
+    Stores the collected state of the current worker in a part file.
+
+    :param state_file: file name prefix of the part file
+    :return: None
+    """
+    state = {'counts': word_counts, 'sentences': sentence_count, 'lengths': sentence_lengths, 'times': stage_times}
+    with open('{}.{}{}'.format(state_file, os.getpid(), PART_SUFFIX), 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_worker_states(state_file):
+    """
+    Loads and removes the part files of all workers.
+
+    :param state_file: file name prefix of the part files
+    :return: list of worker states
+    """
+    states = []
+    for part in glob.glob('{}.*{}'.format(glob.escape(state_file), PART_SUFFIX)):
+        with open(part, 'rb') as f:
+            states.append(pickle.load(f))
+        os.remove(part)
+    return states
+
+
+def merge_counts(states):
+    """
+    Merges the word counts of all workers.
+
+    :param states: list of worker states
+    :return: tuple of word counts as Counter and sentence count
+    """
+    counts = collections.Counter()
+    sentences = 0
+    for state in states:
+        counts.update(state['counts'])
+        sentences += state['sentences']
+    return counts, sentences
+
+
+def write_counts(counts_file, counts, sentences):
+    """
+    Stores merged word counts in a counts file with the sentence count as header.
+
+    :param counts_file: counts file
+    :param counts: word counts as Counter
+    :param sentences: sentence count
+    :return: None
+    """
+    with open(counts_file, 'w', encoding='utf-8') as f:
+        f.write('# {} sentences\n'.format(sentences))
+        for word, count in counts.most_common():
+            f.write('{} {}\n'.format(count, word))
+    logging.info('counted {} words of {} distinct words in {} sentences'.format(
+        sum(counts.values()), len(counts), sentences
+    ))
+
+
+def write_stats(stats_file, counts, sentences, states, corpus_bytes):
+    """
+    Stores corpus statistics computed from the merged worker states in a json file.
+
+    :param stats_file: stats file
+    :param counts: merged word counts as Counter
+    :param sentences: sentence count
+    :param states: list of worker states with sentence length histograms
+    :param corpus_bytes: size of the corpus file
+    :return: None
+    """
+    lengths = collections.Counter()
+    for state in states:
+        lengths.update(state['lengths'])
+    tokens = sum(counts.values())
+    frequencies = collections.Counter(counts.values())
+    # vocabulary size and covered tokens for common values of training.py --mincount
+    by_min_count = {}
+    for min_count in (1, 2, 5, 10, 20, 50, 100):
+        kept = [(count, types) for count, types in frequencies.items() if count >= min_count]
+        by_min_count[min_count] = {
+            'types': sum(types for count, types in kept),
+            'tokens': sum(count * types for count, types in kept)
+        }
+    median = None
+    seen = 0
+    for length in sorted(lengths):
+        seen += lengths[length]
+        if 2 * seen >= sentences:
+            median = length
+            break
+    stats = {
+        'sentences': sentences,
+        'tokens': tokens,
+        'types': len(counts),
+        'type_token_ratio': len(counts) / float(tokens) if tokens else None,
+        'bytes': corpus_bytes,
+        'mean_sentence_length': tokens / float(sentences) if sentences else None,
+        'median_sentence_length': median,
+        'max_sentence_length': max(lengths) if lengths else None,
+        'sentence_lengths': [[length, lengths[length]] for length in sorted(lengths)],
+        'min_count': by_min_count
+    }
+    with open(stats_file, 'w') as f:
+        json.dump(stats, f, indent=2)
+    logging.info('{} tokens of {} types in {} sentences, type/token ratio {:.4f}, mean sentence length {:.1f}'.format(
+        tokens, len(counts), sentences, stats['type_token_ratio'] or 0, stats['mean_sentence_length'] or 0
+    ))
+
+
+def remove_worker_states(state_file):
+    """
+    Removes part files left behind by an interrupted run.
+
+    :param state_file: file name prefix of the part files
+    :return: None
+    """
+    for part in glob.glob('{}.*{}'.format(glob.escape(state_file), PART_SUFFIX)):
+        os.remove(part)
 
 
-# get corpus sentences
-class CorpusSentences:
+class Profile:
+    """
+    Collects throughput, queue depth and stage timings of a preprocessing run.
+    """
     def __init__(self, filename):
         self.filename = filename
+        self.start = self.last = time.perf_counter()
+        self.lines = self.last_lines = 0
+        self.tokens = self.last_tokens = 0
+        self.depths = []
+        self.times = collections.Counter()
+        self.progress = []
+
+    def report(self, lines, queue_depth):
+        """
+        Logs and records the throughput since the last report.
+
+        :param lines: number of lines processed in this run
+        :param queue_depth: number of lines handed to the workers but not yet written
+        :return: None
+        """
+        now = time.perf_counter()
+        seconds = max(now - self.last, 1e-9)
+        self.depths.append(queue_depth)
+        self.progress.append({
+            'seconds': round(now - self.start, 3),
+            'lines': lines,
+            'lines_per_second': round((lines - self.last_lines) / seconds, 1),
+            'tokens_per_second': round((self.tokens - self.last_tokens) / seconds, 1),
+            'queue_depth': queue_depth
+        })
+        logging.info('{lines_per_second} lines/s, {tokens_per_second} tokens/s, queue depth {queue_depth}'.format(
+            **self.progress[-1]
+        ))
+        self.last, self.last_lines, self.last_tokens = now, lines, self.tokens
+
+    def save(self, lines, states):
+        """
+        Writes the summary of the run as JSON.
+
+        :param lines: number of lines processed in this run
+        :param states: list of worker states
+        :return: None
+        """
+        seconds = max(time.perf_counter() - self.start, 1e-9)
+        worker_times = collections.Counter()
+        for state in states:
+            worker_times.update(state['times'] or {})
+        summary = {
+            'threads': args.threads,
+            'batch_size': args.batch_size,
+            'seconds': round(seconds, 3),
+            'lines': lines,
+            'tokens': self.tokens,
+            'lines_per_second': round(lines / seconds, 1),
+            'tokens_per_second': round(self.tokens / seconds, 1),
+            'queue_depth': {
+                'mean': round(sum(self.depths) / len(self.depths), 1) if self.depths else 0,
+                'max': max(self.depths) if self.depths else 0
+            },
+            'worker_seconds': {stage: round(t, 3) for stage, t in worker_times.most_common()},
+            'main_seconds': {stage: round(t, 3) for stage, t in self.times.most_common()},
+            'progress': self.progress
+        }
+        with open(self.filename, 'w') as f:
+            json.dump(summary, f, indent=2)
+        logging.info('stored profile of {} lines/s, {} tokens/s in {}'.format(
+            summary['lines_per_second'], summary['tokens_per_second'], self.filename
+        ))
+
+
+def normalize_line(line, fold_digits=False):
+    """
+    Normalizes the given line for duplicate detection, ignoring case, punctuation and spacing.
+
+    :param line: line as str
+    :param fold_digits: also ignore digit values, so lines differing only in numbers are duplicates
+    :return: normalized line as str
+    """
+    normalized = ' '.join(normalization_pattern.findall(line.casefold()))
+    return re.sub(r'\d', '0', normalized) if fold_digits else normalized
+
+
+class BloomFilter:
+    """
+    Fixed size set of hashed lines that answers membership with a small false positive rate.
+    """
+    hashes = 7
+
+    def __init__(self, filename, memory):
+        self.filename = filename
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                self.bits = bytearray(f.read())
+        else:
+            self.bits = bytearray(memory * 1024 * 1024)
+        self.size = len(self.bits) * 8
+
+    def add(self, item):
+        """
+        Adds the given item to the filter.
+
+        :param item: item as str
+        :return: True if the item was (probably) already contained
+        """
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        contained = True
+        for i in range(self.hashes):
+            bit = (h1 + i * h2) % self.size
+            mask = 1 << (bit & 7)
+            if not self.bits[bit >> 3] & mask:
+                self.bits[bit >> 3] |= mask
+                contained = False
+        return contained
+
+    def save(self):
+        """
+        Atomically writes the filter to its file.
+
+        :return: None
+        """
+        with open(self.filename + TMP_SUFFIX, 'wb') as f:
+            f.write(self.bits)
+        os.replace(self.filename + TMP_SUFFIX, self.filename)
+
+
+def raw_files(raw):
+    """
+    Lists the raw input files, which is either the given file or every WikiExtractor shard in the given directory.
+
+    :param raw: raw file or WikiExtractor output directory
+    :return: list of file names
+    """
+    if not os.path.isdir(raw):
+        return [raw]
+    shards = []
+    for dirpath, _, filenames in os.walk(raw):
+        shards.extend(os.path.join(dirpath, fname) for fname in filenames if fname.startswith('wiki_'))
+    return sorted(shards)
+
+
+def read_lines(files, position, wiki=False, seen=None, stats=None, times=None, fold_digits=False):
+    """
+    Reads the lines of the given raw files together with the input position reached after each line.
+
+    :param files: list of raw files, files ending with .bz2 are decompressed on the fly
+    :param position: (file index, byte offset) tuple to start reading at
+    :param wiki: drop the <doc ...> and </doc> lines of WikiExtractor shards
+    :param seen: optional BloomFilter to drop already seen lines with
+    :param stats: optional Counter to count read bytes, documents and dropped lines and bytes in
+    :param times: optional Counter to add the reading time to
+    :param fold_digits: ignore digit values when comparing lines with seen
+    :return: generator of ((file index, byte offset), line as str) tuples
+    """
+    stats = collections.Counter() if stats is None else stats
+    index, offset = position
+    start = time.perf_counter()
+    for index in range(index, len(files)):
+        with (bz2.open if files[index].endswith('.bz2') else open)(files[index], 'rb') as infile:
+            infile.seek(offset)
+            for line in infile:
+                offset += len(line)
+                stats['bytes'] += len(line)
+                if wiki and (line.startswith(b'<doc ') or line.startswith(b'</doc>')):
+                    stats['documents'] += line.startswith(b'<doc ')
+                    continue
+                text = line.decode('utf-8')
+                if seen is not None:
+                    normalized = normalize_line(text, fold_digits)
+                    if normalized and seen.add(normalized):
+                        stats['duplicate lines'] += 1
+                        stats['duplicate bytes'] += len(line)
+                        continue
+                if times is not None:
+                    times['reading'] += time.perf_counter() - start
+                yield (index, offset), text
+                start = time.perf_counter()
+        offset = 0
+
+
+def read_batches(lines, size, window, window_size, drain=0, fed=None):
+    """
+    Groups lines into batches and keeps at most window_size batches in flight.
+
+    :param lines: iterable of (input offset, line) tuples
+    :param size: number of lines per batch
+    :param window: semaphore the consumer releases for every finished batch
+    :param window_size: initial value of the semaphore
+    :param drain: wait until no batch is in flight after every drain batches, 0 to never wait
+    :param fed: optional Counter to count the handed out lines in
+    :return: generator of (input offset after the batch, list of lines) tuples
+    """
+    lines = iter(lines)
+    for index in itertools.count(1):
+        batch = list(itertools.islice(lines, size))
+        if not batch:
+            return
+        window.acquire()
+        if fed is not None:
+            fed['lines'] += len(batch)
+        yield batch[-1][0], [line for _, line in batch]
+        if drain and index % drain == 0:
+            for _ in range(window_size):
+                window.acquire()
+            for _ in range(window_size):
+                window.release()
+
+
+def write_checkpoint(filename, state):
+    """
+    Atomically replaces the checkpoint file with the given state.
+
+    :param filename: checkpoint file name
+    :param state: checkpoint state as dict
+    :return: None
+    """
+    with open(filename + TMP_SUFFIX, 'w') as f:
+        json.dump(state, f)
+    os.replace(filename + TMP_SUFFIX, filename)
+
+
+def output_files(filename, shards):
+    """
+    Gets the names of the output files of a corpus.
+
+    :param filename: target file name of the corpus
+    :param shards: number of output files
+    :return: list of file names, the target itself if the corpus is not sharded
+    """
+    if shards == 1:
+        return [filename]
+    return ['{}{}{}'.format(filename, SHARD_SUFFIX, k) for k in range(shards)]
+
+
+def corpus_shards(filenames, count):
+    """
+    Splits the given files into byte ranges of roughly equal size that start and end at line boundaries.
+
+    :param filenames: list of files to split
+    :param count: total number of shards
+    :return: list of (filename, start, end) tuples
+    """
+    shards = []
+    per_file = max(count // len(filenames), 1)
+    for filename in filenames:
+        size = os.path.getsize(filename)
+        boundaries = [0]
+        with open(filename, 'rb') as f:
+            for i in range(1, per_file):
+                f.seek(max(size * i // per_file - 1, boundaries[-1]))
+                f.readline()
+                boundaries.append(min(f.tell(), size))
+        boundaries.append(size)
+        shards.extend((filename, start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start)
+    return shards
+
+
+def read_shard(filename, start, end):
+    """
+    Reads the lines of a byte range of the given file.
+
+    :param filename: file to read
+    :param start: first byte of the range
+    :param end: first byte after the range
+    :return: generator of lines as str
+    """
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode('utf-8')
+
+
+def prune_counts(counts, min_reduce):
+    """
+    Removes all entries with a count below the given minimum, like gensim does for its phrase vocabulary.
+
+    :param counts: dict of counts
+    :param min_reduce: minimum count to keep
+    :return: None
+    """
+    for key in [key for key, count in counts.items() if count < min_reduce]:
+        del counts[key]
+
+
+def count_phrases(shard):
+    """
+    Counts unigram and bigram phrase candidates in the given corpus shard, keyed like gensim's Phrases vocabulary.
+
+    :param shard: (filename, start, end) tuple
+    :return: tuple of candidate counts, their prune level and the number of words
+    """
+    counts = collections.Counter()
+    min_reduce = 1
+    words = 0
+    max_size = max(args.max_vocab_size // args.threads, 1)
+    for line in read_shard(*shard):
+        sentence = [x.encode('utf-8') for x in line.split()]
+        for word_a, word_b in zip(sentence, sentence[1:]):
+            counts[word_a] += 1
+            counts[b'_'.join((word_a, word_b))] += 1
+        if sentence:
+            counts[sentence[-1]] += 1
+        words += len(sentence)
+        if len(counts) > max_size:
+            prune_counts(counts, min_reduce)
+            min_reduce += 1
+    return counts, min_reduce, words
+
+
+class CountMinSketch:
+    """
+    Fixed size table of approximate bigram counts, which may overestimate but never underestimates a count.
+    """
+    depth = 4
+    # largest and smallest number of bigrams hashed and counted at once, their peak memory in bytes each while
+    # buffered and counted and the share of the memory of the sketches the buffers of all workers may take
+    block = 65536
+    min_block = 1024
+    block_bytes = 300
+    buffer_share = 0.25
+
+    def __init__(self, width):
+        import numpy as np
+        self.width = width
+        self.table = np.zeros((self.depth, width), dtype=np.uint32)
+
+    @staticmethod
+    def digest(word_a, word_b):
+        """
+        Hashes the given bigram into one 32 bit value per table row plus one for sampling.
+
+        :param word_a: first word as str
+        :param word_b: second word as str
+        :return: digest as bytes
+        """
+        return hashlib.blake2b('{} {}'.format(word_a, word_b).encode('utf-8'), digest_size=20).digest()
+
+    def add(self, digests):
+        """
+        Counts the bigrams of the given digests.
+
+        :param digests: list of digests
+        :return: array of the 32 bit hash values with one row per digest
+        """
+        import numpy as np
+        hashes = np.frombuffer(b''.join(digests), dtype=np.uint32).reshape(-1, self.depth + 1)
+        for row in range(self.depth):
+            np.add.at(self.table[row], hashes[:, row] % self.width, 1)
+        return hashes
+
+    def estimate(self, digest):
+        """
+        Estimates the count of the bigram of the given digest.
+
+        :param digest: digest as bytes
+        :return: estimated count
+        """
+        return min(
+            int(self.table[row, int.from_bytes(digest[row * 4:row * 4 + 4], sys.byteorder) % self.width])
+            for row in range(self.depth)
+        )
+
+    def distinct(self):
+        """
+        Estimates the number of distinct bigrams from the share of empty cells in the first row (linear counting).
+
+        :return: estimated number of distinct bigrams
+        """
+        import numpy as np
+        empty = max(int(np.count_nonzero(self.table[0] == 0)), 1)
+        return int(-self.width * math.log(empty / self.width))
+
+
+def count_sketch(job):
+    """
+    Counts the unigrams of the given corpus shard exactly and its bigrams in a count-min sketch.
+    Bigrams falling into the sample are also counted exactly to measure the accuracy of the sketch.
+
+    :param job: tuple of (filename, start, end) shard, sketch width, sample rate and number of bigrams counted at once
+    :return: tuple of unigram counts, sketch, exact counts of sampled bigrams and the number of words
+    """
+    shard, width, sample, block = job
+    unigrams = collections.Counter()
+    sketch = CountMinSketch(width)
+    sampled = collections.Counter()
+    limit = int(sample * 2 ** 32)
+    words = 0
+    bigrams = []
+    digests = []
+    for line in read_shard(*shard):
+        sentence = line.split()
+        unigrams.update(sentence)
+        words += len(sentence)
+        for bigram in zip(sentence, sentence[1:]):
+            bigrams.append(bigram)
+            digests.append(CountMinSketch.digest(*bigram))
+        # hash and count bigrams in blocks to keep the per bigram overhead low
+        if len(digests) >= block:
+            hashes = sketch.add(digests)
+            for i in (hashes[:, CountMinSketch.depth] < limit).nonzero()[0]:
+                sampled[bigrams[i]] += 1
+            bigrams, digests = [], []
+    if digests:
+        hashes = sketch.add(digests)
+        for i in (hashes[:, CountMinSketch.depth] < limit).nonzero()[0]:
+            sampled[bigrams[i]] += 1
+    return unigrams, sketch, sampled, words
+
+
+class SketchPhraser:
+    """
+    Bigram phrase detector scoring like gensim's Phrases, with bigram counts taken from a count-min sketch.
+    """
+    def __init__(self, unigrams, sketch):
+        self.unigrams = unigrams
+        self.sketch = sketch
+        # gensim scores with the number of unigram and bigram entries of its vocabulary
+        self.vocab_size = len(unigrams) + sketch.distinct()
+
+    def score(self, count_a, count_b, count_ab):
+        """
+        Scores a bigram like gensim's Phrases.
+
+        :param count_a: count of the first word
+        :param count_b: count of the second word
+        :param count_ab: count of the bigram
+        :return: score
+        """
+        return (count_ab - phrases_min_count) / float(count_a) / count_b * self.vocab_size
+
+    def __getitem__(self, sentence):
+        """
+        Joins the detected bigram phrases of the given sentence, like gensim's Phrases.
+
+        :param sentence: list of word tokens
+        :return: list of word and phrase tokens
+        """
+        phrased = []
+        last_bigram = False
+        for word_a, word_b in zip(sentence, sentence[1:]):
+            count_a = self.unigrams.get(word_a)
+            count_b = self.unigrams.get(word_b)
+            # the bigram count is bounded by the smaller word count, which rules out most pairs without a lookup
+            if count_a and count_b and not last_bigram and \
+                    self.score(count_a, count_b, min(count_a, count_b)) > phrases_threshold:
+                count_ab = self.sketch.estimate(CountMinSketch.digest(word_a, word_b))
+                if self.score(count_a, count_b, count_ab) > phrases_threshold:
+                    phrased.append('{}_{}'.format(word_a, word_b))
+                    last_bigram = True
+                    continue
+            if not last_bigram:
+                phrased.append(word_a)
+            last_bigram = False
+        if sentence and not last_bigram:
+            phrased.append(sentence[-1])
+        return phrased
+
+
+def sketch_report(phraser, sampled):
+    """
+    Compares the sketch estimates of the sampled bigrams with their exact counts.
+
+    :param phraser: SketchPhraser
+    :param sampled: exact counts of sampled bigrams
+    :return: report as dict
+    """
+    errors = []
+    detected = {'both': 0, 'exact': 0, 'sketch': 0}
+    for (word_a, word_b), count in sampled.items():
+        estimate = phraser.sketch.estimate(CountMinSketch.digest(word_a, word_b))
+        errors.append(estimate - count)
+        count_a, count_b = phraser.unigrams[word_a], phraser.unigrams[word_b]
+        exact_phrase = phraser.score(count_a, count_b, count) > phrases_threshold
+        sketch_phrase = phraser.score(count_a, count_b, estimate) > phrases_threshold
+        if exact_phrase and sketch_phrase:
+            detected['both'] += 1
+        elif exact_phrase:
+            detected['exact'] += 1
+        elif sketch_phrase:
+            detected['sketch'] += 1
+    sampled_count = max(len(errors), 1)
+    sketch_phrases = detected['both'] + detected['sketch']
+    exact_phrases = detected['both'] + detected['exact']
+    return {
+        'width': phraser.sketch.width,
+        'depth': phraser.sketch.depth,
+        'memory_mb': round(phraser.sketch.table.nbytes / 1024.0 / 1024.0, 1),
+        'distinct_bigrams_estimate': phraser.vocab_size - len(phraser.unigrams),
+        'sampled_bigrams': len(errors),
+        'exact_estimates': round(sum(1 for e in errors if e == 0) / float(sampled_count), 4),
+        'mean_overestimate': round(sum(errors) / float(sampled_count), 3),
+        'max_overestimate': max(errors) if errors else 0,
+        'mean_relative_overestimate': round(
+            sum(e / float(c) for e, c in zip(errors, sampled.values())) / sampled_count, 4
+        ),
+        'phrases_exact': exact_phrases,
+        'phrases_sketch': sketch_phrases,
+        'phrases_both': detected['both'],
+        'phrase_precision': round(detected['both'] / float(sketch_phrases), 4) if sketch_phrases else None,
+        'phrase_recall': round(detected['both'] / float(exact_phrases), 4) if exact_phrases else None
+    }
+
+
+def transform_phrases(job):
+    """
+    Transforms a corpus shard to bigram phrases and writes it into a part file.
+
+    :param job: tuple of part file name and (filename, start, end) shard
+    :return: tuple of part file name and the corpus file of the shard
+    """
+    part, shard = job
+    with open(part, 'w', encoding='utf-8') as outfile:
+        for line in read_shard(*shard):
+            words = phraser[line.split()]
+            count_words(words)
+            outfile.write('{}\n'.format(' '.join(words)))
+    return part, shard[0]
+
+
+def write_id_corpus(filename):
+    """
+    Stores the given corpus as uint32 token ids with uint64 sentence offsets and a vocabulary file.
+
+    :param filename: finished corpus file
+    :return: None
+    """
+    word_ids = {}
+    tokens = array.array('I')
+    offsets = array.array('Q', [0])
+    written = 0
+    with open(filename, encoding='utf-8') as infile, open(filename + IDS_SUFFIX, 'wb') as idfile, \
+            open(filename + IDS_OFFSETS_SUFFIX, 'wb') as offsetfile:
+        for line in infile:
+            for word in line.split():
+                word_id = word_ids.get(word)
+                if word_id is None:
+                    word_id = word_ids[word] = len(word_ids)
+                tokens.append(word_id)
+            offsets.append(written + len(tokens))
+            # write buffered ids in blocks to keep memory constant
+            if len(tokens) >= 1048576:
+                tokens.tofile(idfile)
+                offsets.tofile(offsetfile)
+                written += len(tokens)
+                tokens = array.array('I')
+                offsets = array.array('Q')
+        tokens.tofile(idfile)
+        offsets.tofile(offsetfile)
+    with open(filename + IDS_VOCAB_SUFFIX, 'w', encoding='utf-8') as vocabfile:
+        for word in word_ids:
+            vocabfile.write('{}\n'.format(word))
+    logging.info('stored {} tokens with {} distinct words as ids'.format(written + len(tokens), len(word_ids)))
+
+
+if __name__ == '__main__':
+    # configuration
+    parser = argparse.ArgumentParser(description='Script for preprocessing public corpora')
+    parser.add_argument(
+        'raw', type=str, help='source file with raw data for corpus creation, or a WikiExtractor output directory'
+    )
+    parser.add_argument('target', type=str, help='target file name to store corpus in')
+    parser.add_argument('-p', '--punctuation', action='store_true', help='remove punctuation tokens')
+    parser.add_argument('-s', '--stopwords', action='store_true', help='remove stop word tokens')
+    parser.add_argument(
+        '-u', '--umlauts', action='store_true', help='replace german umlauts with their respective digraphs'
+    )
+    parser.add_argument('-b', '--bigram', action='store_true', help='detect and process common bigram phrases')
+    parser.add_argument(
+        '--max_vocab_size', type=int, default=40000000, help='maximum number of phrase candidates kept while counting'
+    )
+    parser.add_argument(
+        '--phrases', choices=['exact', 'sketch'], default='exact',
+        help='count bigram phrase candidates exactly with gensim or in a fixed size count-min sketch'
+    )
+    parser.add_argument(
+        '--sketch_memory', type=int, default=1024,
+        help='total memory for counting bigrams in count-min sketches in MB, including the buffers of all workers'
+    )
+    parser.add_argument(
+        '--sketch_sample', type=float, default=0.001,
+        help='share of bigrams counted exactly to report the accuracy of the count-min sketch'
+    )
+    parser.add_argument('-t', '--threads', type=int, default=mp.cpu_count(), help='thread count')
+    parser.add_argument('--batch_size', type=int, default=32, help='batch size for multiprocessing')
+    parser.add_argument(
+        '--unordered', action='store_true', help='write sentences in order of completion instead of input order'
+    )
+    parser.add_argument(
+        '--shards', type=int, default=1,
+        help='number of output files to distribute the corpus over for parallel reading'
+    )
+    parser.add_argument(
+        '--shard_by', choices=['roundrobin', 'hash'], default='roundrobin',
+        help='distribute batches to the output files in turn or sentences by a hash of their content'
+    )
+    parser.add_argument('--window', type=int, help='maximum number of batches in flight (default: 4 per thread)')
+    parser.add_argument(
+        '--profile', action='store_true', help='log throughput and store stage timings in a .profile.json file'
+    )
+    parser.add_argument(
+        '-r', '--resume', action='store_true', help='resume an interrupted run from its last checkpoint'
+    )
+    parser.add_argument(
+        '--checkpoint_interval', type=int, default=25000, help='number of raw lines between two progress checkpoints'
+    )
+    parser.add_argument(
+        '-c', '--counts', action='store_true',
+        help='collect word counts for training.py in a .counts file next to the corpus'
+    )
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='collect sentence, token and type counts and sentence lengths in a .stats.json file next to the corpus'
+    )
+    parser.add_argument(
+        '--ids', action='store_true', help='additionally store the corpus as binary token ids for fast training'
+    )
+    parser.add_argument(
+        '--dedup', type=str, help='drop duplicate lines, remembering seen lines in the given filter file across runs'
+    )
+    parser.add_argument('--dedup_memory', type=int, default=256, help='size of a new dedup filter file in MB')
+    parser.add_argument(
+        '--fold_digits', action='store_true',
+        help='with --dedup, also drop lines that only differ from a seen line in their digits'
+    )
+    args = parser.parse_args()
+    args.window = args.window or 4 * args.threads
+    logging.basicConfig(stream=sys.stdout, format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+
+    if not os.path.exists(os.path.dirname(args.target)):
+        os.makedirs(os.path.dirname(args.target))
+
+    # a checkpoint records how far the raw input was consumed and the size of the output written for it
+    checkpoint_file = args.target + CHECKPOINT_SUFFIX
+    options = {
+        'punctuation': args.punctuation, 'stopwords': args.stopwords, 'umlauts': args.umlauts,
+        'shards': args.shards, 'shard_by': args.shard_by, 'phrases': args.phrases, 'ids': args.ids,
+        'dedup': os.path.abspath(args.dedup) if args.dedup else None, 'fold_digits': args.fold_digits
+    }
+    checkpoint = {
+        'raw': os.path.abspath(args.raw), 'options': options, 'input_position': [0, 0],
+        'output_offset': [0] * args.shards, 'lines': 0
+    }
+    if args.resume and os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            checkpoint = json.load(f)
+        if checkpoint['raw'] != os.path.abspath(args.raw) or checkpoint['options'] != options:
+            sys.exit('checkpoint {} belongs to a different raw file or options'.format(checkpoint_file))
+        logging.info('resuming after {} lines at input position {}'.format(
+            checkpoint['lines'], checkpoint['input_position']
+        ))
+    elif args.resume:
+        logging.warning('no checkpoint found, starting from the beginning')
+
+    # with --shards, the corpus is written to several files instead of the target file itself
+    outputs = output_files(args.target, args.shards)
+    if checkpoint.get('finished'):
+        logging.info('preprocessing already finished, skipping to next step')
+    else:
+        # WikiExtractor output directories are read shard by shard instead of a single raw file
+        files = raw_files(args.raw)
+        wiki = os.path.isdir(args.raw)
+        resumed_position = tuple(checkpoint['input_position'])
+        # the filter file is only updated after a finished run, so it never contains lines past the checkpoint
+        seen = BloomFilter(args.dedup, args.dedup_memory) if args.dedup else None
+        stats = collections.Counter()
+        # drop output written after the last checkpoint and continue reading from the matching input position
+        if checkpoint['lines']:
+            for output, offset in zip(outputs, checkpoint['output_offset']):
+                os.truncate(output, offset)
+            if seen is not None:
+                logging.info('restoring dedup filter from already processed input')
+                for position, line in read_lines(files, (0, 0), wiki):
+                    if position > resumed_position:
+                        break
+                    seen.add(normalize_line(line, args.fold_digits))
+        # start pre processing with multiple threads
+        remove_worker_states(args.target)
+        profile = Profile(args.target + PROFILE_SUFFIX) if args.profile else None
+        times = profile.times if profile else None
+        pool = mp.Pool(args.threads, initializer=init_worker, initargs=(args, args.target, True))
+        # words of the output kept from an interrupted run are counted again by one of the workers
+        recounts = []
+        if (args.counts or args.stats) and checkpoint['lines']:
+            recounts = [
+                pool.apply_async(count_range, (output, 0, offset))
+                for output, offset in zip(outputs, checkpoint['output_offset'])
+            ]
+        # unordered results only match an input position once every batch in flight is written,
+        # so the reader waits for that before each checkpoint
+        checkpoint_batches = max(args.checkpoint_interval // args.batch_size, 1)
+        window = threading.Semaphore(args.window)
+        fed = collections.Counter()
+        lines = read_lines(files, resumed_position, wiki, seen, stats, times, args.fold_digits)
+        batches = read_batches(
+            lines, args.batch_size, window, args.window, checkpoint_batches if args.unordered else 0, fed
+        )
+        values = (pool.imap_unordered if args.unordered else pool.imap)(process_batch, batches)
+        resumed_lines = checkpoint['lines']
+        outfiles = [open(output, 'a' if resumed_lines else 'w', encoding='utf-8') for output in outputs]
+        i = resumed_lines
+        position = resumed_position
+        start = time.perf_counter()
+        for batch, (batch_position, count, parts) in enumerate(values, start=1):
+            if profile:
+                now = time.perf_counter()
+                profile.times['waiting for workers'] += now - start
+                start = now
+            if len(parts) == 1:
+                outfiles[batch % len(outfiles)].write(parts[0])
+            else:
+                for outfile, part in zip(outfiles, parts):
+                    outfile.write(part)
+            if profile:
+                profile.tokens += sum(part.count(' ') + part.count('\n') for part in parts)
+            i += count
+            position = max(position, batch_position)
+            if i // 25000 > (i - count) // 25000:
+                logging.info('processed {} sentences'.format(i))
+                if profile:
+                    profile.report(i - resumed_lines, fed['lines'] - (i - resumed_lines))
+            if batch % checkpoint_batches == 0:
+                for outfile in outfiles:
+                    outfile.flush()
+                    os.fsync(outfile.fileno())
+                checkpoint.update(
+                    input_position=position, output_offset=[outfile.tell() for outfile in outfiles], lines=i
+                )
+                write_checkpoint(checkpoint_file, checkpoint)
+            window.release()
+            if profile:
+                now = time.perf_counter()
+                profile.times['writing'] += now - start
+                start = now
+        checkpoint.update(
+            input_position=[len(files), 0], output_offset=[outfile.tell() for outfile in outfiles], lines=i,
+            finished=True
+        )
+        for outfile in outfiles:
+            outfile.close()
+        logging.info('preprocessing of {} sentences finished!'.format(i))
+        for recount in recounts:
+            recount.get()
+        pool.close()
+        pool.join()
+        states = load_worker_states(args.target)
+        if args.counts or args.stats:
+            counts, sentences = merge_counts(states)
+            if args.counts:
+                write_counts(args.target + COUNTS_SUFFIX, counts, sentences)
+            if args.stats:
+                stats_file = args.target + STATS_SUFFIX
+                write_stats(stats_file, counts, sentences, states, sum(map(os.path.getsize, outputs)))
+            del counts
+        if profile:
+            profile.save(i - resumed_lines, states)
+        write_checkpoint(checkpoint_file, checkpoint)
+        if wiki:
+            logging.info('read {} documents from {} WikiExtractor shards'.format(stats['documents'], len(files)))
+        if seen is not None:
+            seen.save()
+            removed_share = stats['duplicate bytes'] * 100.0 / max(stats['bytes'], 1)
+            logging.info('removed {} duplicate lines with {} bytes ({:.1f}% of the processed input volume)'.format(
+                stats['duplicate lines'], stats['duplicate bytes'], removed_share
+            ))
+
+
+    if args.bigram:
+        if args.phrases == 'sketch':
+            # count unigrams exactly and bigrams in one count-min sketch per worker, the sketches are summed up
+            logging.info('train bigram phrase detector with count-min sketch')
+            # the memory holds the bigram blocks of the workers, one sketch per worker, the summed sketch and a
+            # shard sketch on its way to the main process, which is pickled in the worker and received at once,
+            # the blocks get smaller with more workers to leave most of the memory to the sketches
+            memory = args.sketch_memory * 1024 * 1024
+            block = int(memory * CountMinSketch.buffer_share) // args.threads // CountMinSketch.block_bytes
+            block = max(min(block, CountMinSketch.block), CountMinSketch.min_block)
+            buffers = args.threads * block * CountMinSketch.block_bytes
+            width = (memory - buffers) // (args.threads + 3) // (CountMinSketch.depth * 4)
+            if width < 1:
+                sys.exit('--sketch_memory of {} MB does not cover the {} MB of bigram buffers of {} threads'.format(
+                    args.sketch_memory, buffers // (1024 * 1024), args.threads
+                ))
+            pool = mp.Pool(args.threads, initializer=init_worker, initargs=(args,))
+            unigrams = collections.Counter()
+            sketch = CountMinSketch(width)
+            sampled = collections.Counter()
+            total_words = 0
+            jobs = [(shard, width, args.sketch_sample, block) for shard in corpus_shards(outputs, args.threads)]
+            for shard_unigrams, shard_sketch, shard_sampled, words in pool.imap_unordered(count_sketch, jobs):
+                unigrams.update(shard_unigrams)
+                sketch.table += shard_sketch.table
+                sampled.update(shard_sampled)
+                total_words += words
+                del shard_unigrams, shard_sketch
+            pool.close()
+            pool.join()
+            phraser = SketchPhraser(dict(unigrams), sketch)
+            del unigrams
+            logging.info('collected {} words and about {} distinct bigrams from {} words'.format(
+                len(phraser.unigrams), phraser.vocab_size - len(phraser.unigrams), total_words
+            ))
+            # compare the sketch with exact counts of the sampled bigrams
+            report = sketch_report(phraser, sampled)
+            with open(args.target + SKETCH_SUFFIX, 'w') as f:
+                json.dump(report, f, indent=2)
+            logging.info((
+                'sketch accuracy on {sampled_bigrams} sampled bigrams: {exact_estimates:.1%} exact, '
+                'mean overestimate {mean_overestimate}, {phrases_both} of {phrases_exact} exact phrases '
+                'and {phrases_sketch} sketch phrases agree'
+            ).format(**report))
+        else:
+            # gensim is only needed for exact bigram phrases
+            import gensim
+            # count phrase candidates on shards in parallel, merging and pruning the counts as they arrive
+            logging.info('train bigram phrase detector')
+            pool = mp.Pool(args.threads, initializer=init_worker, initargs=(args,))
+            vocab = collections.defaultdict(int)
+            min_reduce = 1
+            total_words = 0
+            shards = corpus_shards(outputs, args.threads)
+            for counts, shard_min_reduce, words in pool.imap_unordered(count_phrases, shards):
+                min_reduce = max(min_reduce, shard_min_reduce)
+                total_words += words
+                for key, count in counts.items():
+                    vocab[key] += count
+                del counts
+                if len(vocab) > args.max_vocab_size:
+                    prune_counts(vocab, min_reduce)
+                    min_reduce += 1
+            pool.close()
+            pool.join()
+            bigram = gensim.models.Phrases(max_vocab_size=args.max_vocab_size)
+            bigram.vocab = vocab
+            bigram.min_reduce = min_reduce
+            bigram.corpus_word_count = total_words
+            logging.info('collected {} phrase candidates from {} words'.format(len(vocab), total_words))
+            phraser = gensim.models.phrases.Phraser(bigram)
+            del bigram, vocab
+        # transform the shards in parallel into part files and join them in corpus order
+        logging.info('transform corpus to bigram phrases')
+        jobs = [
+            ('{}.bigram{}{}'.format(args.target, PART_SUFFIX, i), shard)
+            for i, shard in enumerate(corpus_shards(outputs, args.threads))
+        ]
+        state_file = '{}.bigram'.format(args.target)
+        remove_worker_states(state_file)
+        pool = mp.Pool(args.threads, initializer=init_worker, initargs=(args, state_file, False, phraser))
+        # every output file of the corpus gets a matching bigram output file
+        bigram_outputs = output_files(state_file, args.shards)
+        outfiles = {output: open(bigram_output, 'wb') for output, bigram_output in zip(outputs, bigram_outputs)}
+        for part, output in pool.imap(transform_phrases, jobs):
+            with open(part, 'rb') as infile:
+                shutil.copyfileobj(infile, outfiles[output])
+            os.remove(part)
+        for outfile in outfiles.values():
+            outfile.close()
+        outputs = bigram_outputs
+        pool.close()
+        pool.join()
+        states = load_worker_states(state_file)
+        if args.counts or args.stats:
+            counts, sentences = merge_counts(states)
+            if args.counts:
+                write_counts(state_file + COUNTS_SUFFIX, counts, sentences)
+            if args.stats:
+                stats_file = state_file + STATS_SUFFIX
+                write_stats(stats_file, counts, sentences, states, sum(map(os.path.getsize, outputs)))
+            del counts
+
+    if args.ids:
+        logging.info('store corpus as token ids')
+        for output in outputs:
+            write_id_corpus(output)
 
-    def __iter__(self):
-        for line in open(self.filename):
-            yield line.split()
-
-if args.bigram:
-    logging.info('train bigram phrase detector')
-    bigram = gensim.models.Phrases(CorpusSentences(args.target))
-    logging.info('transform corpus to bigram phrases')
-    with open('{}.bigram'.format(args.target), 'w') as outfile:
-        for tokens in bigram[CorpusSentences(args.target)]:
-            outfile.write('{}\n'.format(' '.join(tokens)))
+    # the run is complete, so there is nothing left to resume
+    os.remove(checkpoint_file)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+# reading the .result files of models and evaluating models with evaluation.py, shared by the scripts comparing models
+#
+# @see: Bachelor Thesis 'Analyse von Wort-Vektoren deutscher Textkorpora'
+
+import os
+import re
+import subprocess
+import sys
+
+# metrics logged by evaluation.py and training.py into the .result file of a model
+METRIC_PATTERN = re.compile(r"(total|opposite|best match|doesn't fit) (correct|top \d+|coverage):\s+([\d.]+)%")
+TRAINING_PATTERN = re.compile(r'trained \d+ epochs in (\d+) seconds with (\d+) words/s')
+METRICS = [
+    'total correct', 'total top', 'total coverage', 'opposite correct', 'opposite top', 'best match correct',
+    'best match top', "doesn't fit correct"
+]
+
+
+def read_results(result_file):
+    """
+    Reads training throughput and evaluation metrics from the result file of a model.
+
+    :param result_file: .result file written by training.py and evaluation.py
+    :return: dict of metric names and values, empty if the file doesn't exist
+    """
+    results = {}
+    if not os.path.exists(result_file):
+        return results
+    with open(result_file) as f:
+        for line in f:
+            match = METRIC_PATTERN.search(line)
+            if match:
+                # the top n metric is stored without n, which is the same for all compared models
+                metric = match.group(2) if not match.group(2).startswith('top') else 'top'
+                results['{} {}'.format(match.group(1), metric)] = float(match.group(3))
+                continue
+            match = TRAINING_PATTERN.search(line)
+            if match:
+                results['seconds'] = int(match.group(1))
+                results['words/s'] = int(match.group(2))
+    return results
+
+
+def evaluate_model(model_file, topn, umlauts=False):
+    """
+    Evaluates the given stored model with evaluation.py, which logs its metrics into the .result file of the model.
+
+    :param model_file: binary word2vec model
+    :param topn: top n result checked by evaluation.py
+    :param umlauts: evaluate with the test sets with replaced umlauts
+    :return: dict of metric names and values of the .result file
+    """
+    command = [sys.executable, 'evaluation.py', os.path.abspath(model_file), '-t', str(topn)]
+    # evaluation.py finds its test sets relative to the repository
+    subprocess.run(
+        command + (['-u'] if umlauts else []), check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return read_results(model_file + '.result')
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# script to sample nested subsets of given token counts from preprocessed corpora in a single pass
+#
+# @see: Bachelor Thesis 'Analyse von Wort-Vektoren deutscher Textkorpora'
+#
+# @example: python sampling.py corpus/ samples/ -s 133M 266M 530M
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+
+from corpus import COUNTS_SUFFIX, SHARD_PATTERN, STATS_SUFFIX, corpus_files
+
+UNITS = {'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9}
+
+
+def parse_size(size):
+    """
+    Parses a token count with an optional K, M or G suffix.
+
+    :param size: token count as str, e.g. 133M
+    :return: token count as int
+    """
+    if size[-1].upper() in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1].upper()])
+    return int(size)
+
+
+def count_tokens(filenames):
+    """
+    Gets the total token count of the given corpus files from the .stats.json or .counts files
+    of preprocessing.py or, if these are missing, by counting.
+
+    :param filenames: list of corpus files
+    :return: total token count
+    """
+    total = 0
+    corpora = []
+    for filename in filenames:
+        corpus = SHARD_PATTERN.sub('', filename)
+        if os.path.exists(corpus + STATS_SUFFIX) or os.path.exists(corpus + COUNTS_SUFFIX):
+            # the sidecar files of a sharded corpus cover all of its shards
+            if corpus in corpora:
+                continue
+            corpora.append(corpus)
+        else:
+            corpus = filename
+        if os.path.exists(corpus + STATS_SUFFIX):
+            with open(corpus + STATS_SUFFIX) as fp:
+                total += json.load(fp)['tokens']
+        elif os.path.exists(corpus + COUNTS_SUFFIX):
+            with open(corpus + COUNTS_SUFFIX, 'rb') as fp:
+                next(fp)
+                total += sum(int(line.split(b' ', 1)[0]) for line in fp)
+        else:
+            logging.warning('no counts file for {}, counting its tokens in an extra pass'.format(filename))
+            with open(filename, 'rb') as fp:
+                total += sum(len(line.split()) for line in fp)
+    return total
+
+
+# configuration
+parser = argparse.ArgumentParser(description='Script for sampling nested corpus subsets of given token counts')
+parser.add_argument('source', type=str, help='preprocessed corpus file or folder with corpus files')
+parser.add_argument('target', type=str, help='target folder to store one subfolder per subset in')
+parser.add_argument(
+    '-s', '--sizes', type=str, nargs='+', required=True, help='token counts of the subsets, like 133M or 1.2G'
+)
+parser.add_argument(
+    '--total', type=str, help='total token count of the source, taken from .stats.json or .counts files if omitted'
+)
+parser.add_argument('--seed', type=int, default=1, help='seed of the deterministic sampling')
+args = parser.parse_args()
+logging.basicConfig(stream=sys.stdout, format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+
+files = corpus_files(args.source)
+total = parse_size(args.total) if args.total else count_tokens(files)
+sizes = sorted(set(parse_size(size) for size in args.sizes))
+labels = {parse_size(size): size for size in args.sizes}
+if sizes[-1] > total:
+    sys.exit('largest subset of {} tokens exceeds the {} tokens of the source'.format(sizes[-1], total))
+# every sentence draws one random number and goes into all subsets whose sampling rate is above it,
+# so each subset contains all smaller ones
+rates = [size / float(total) for size in sizes]
+rng = random.Random(args.seed)
+tokens = [0] * len(sizes)
+sentences = [0] * len(sizes)
+for size in sizes:
+    os.makedirs(os.path.join(args.target, labels[size]), exist_ok=True)
+for filename in files:
+    logging.info('sampling {}'.format(filename))
+    outfiles = [open(os.path.join(args.target, labels[size], os.path.basename(filename)), 'wb') for size in sizes]
+    with open(filename, 'rb') as fp:
+        for line in fp:
+            draw = rng.random()
+            if draw >= rates[-1]:
+                continue
+            count = len(line.split())
+            for k in range(len(sizes) - 1, -1, -1):
+                if draw >= rates[k]:
+                    break
+                outfiles[k].write(line)
+                tokens[k] += count
+                sentences[k] += 1
+    for outfile in outfiles:
+        outfile.close()
+
+for size, subset_tokens, subset_sentences in zip(sizes, tokens, sentences):
+    logging.info('subset {}: {} tokens ({:+.2%} off target) in {} sentences'.format(
+        labels[size], subset_tokens, subset_tokens / float(size) - 1, subset_sentences
+    ))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# script to train and evaluate a grid of word2vec configurations under a total core budget
+#
+# @see: Bachelor Thesis 'Analyse von Wort-Vektoren deutscher Textkorpora'
+#
+# @example: python sweep.py corpus/ models/ -s 52 100 300 -w 5 10 -g 0 1 --cores 32 -t 8
+
+import argparse
+import concurrent.futures
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import subprocess
+import sys
+
+import training
+from results import METRICS, evaluate_model, read_results
+
+
+def model_name(config):
+    """
+    Names a model after its configuration, like the models in the result folder.
+
+    :param config: dict of training.py options
+    :return: model name as str
+    """
+    name = '{}-{}-{}'.format('SG' if config['sg'] else 'CB', config['size'], config['window'])
+    if config['negative']:
+        name += '-N{}'.format(config['negative'])
+    if not config['hs']:
+        name += '-NOHS'
+    if config['cbowmean'] and not config['sg']:
+        name += '-MEAN'
+    if config['mincount'] != 5:
+        name += '-M{}'.format(config['mincount'])
+    return name
+
+
+def run_job(config, model, threads):
+    """
+    Trains a model with training.py and evaluates it with evaluation.py, skipping finished steps of earlier sweeps.
+
+    :param config: dict of training.py options
+    :param model: file name of the model
+    :param threads: number of training threads
+    :return: dict of metric names and values
+    """
+    results = read_results(model + '.result')
+    if "doesn't fit correct" in results:
+        logging.info('{} already trained and evaluated'.format(model))
+        return results
+    if not os.path.exists(model) or 'seconds' not in results:
+        logging.info('training {} with {} threads'.format(model, threads))
+        command = [
+            sys.executable, os.path.join(directory, 'training.py'), args.corpora, model, '-t', str(threads),
+            '-s', str(config['size']), '-w', str(config['window']), '-m', str(config['mincount']),
+            '-g', str(config['sg']), '-i', str(config['hs']), '-n', str(config['negative']),
+            '-o', str(config['cbowmean']), '--vocab_cache', cache_dir
+        ] + training_args
+        subprocess.run(command, check=True)
+    logging.info('evaluating {}'.format(model))
+    return evaluate_model(model, args.topn, args.umlauts)
+
+
+# configuration, unknown options are passed on to training.py
+parser = argparse.ArgumentParser(description='Script for training and evaluating a grid of model configurations')
+parser.add_argument('corpora', type=str, help='source folder with preprocessed corpora')
+parser.add_argument('target', type=str, help='target folder to store models, their results and the sweep table in')
+parser.add_argument('-s', '--size', type=int, nargs='+', default=[100], help='dimensions of word vectors')
+parser.add_argument('-w', '--window', type=int, nargs='+', default=[5], help='sizes of the sliding window')
+parser.add_argument('-m', '--mincount', type=int, nargs='+', default=[5], help='minimum numbers of occurences')
+parser.add_argument('-g', '--sg', type=int, nargs='+', default=[1], help='training algorithms: Skip-Gram (1), CBOW (0)')
+parser.add_argument('-i', '--hs', type=int, nargs='+', default=[1], help='uses of hierachical sampling')
+parser.add_argument('-n', '--negative', type=int, nargs='+', default=[0], help='numbers of negative samples')
+parser.add_argument('-o', '--cbowmean', type=int, nargs='+', default=[0], help='for CBOW: sum (0) or mean (1)')
+parser.add_argument('--cores', type=int, default=mp.cpu_count(), help='total number of cores used by all jobs')
+parser.add_argument('-t', '--threads', type=int, default=4, help='number of training threads of each job')
+parser.add_argument('--vocab_cache', type=str, help='folder of the shared vocabulary cache (default: corpus folder)')
+parser.add_argument('-u', '--umlauts', action='store_true', help='evaluate with the test sets with replaced umlauts')
+parser.add_argument('--topn', type=int, default=10, help='check the top n result in evaluation')
+args, training_args = parser.parse_known_args()
+logging.basicConfig(stream=sys.stdout, format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+logging.getLogger('gensim').setLevel(logging.WARNING)
+directory = os.path.dirname(os.path.abspath(__file__))
+cache_dir = os.path.abspath(args.vocab_cache or args.corpora)
+args.corpora = os.path.abspath(args.corpora)
+args.target = os.path.abspath(args.target)
+os.makedirs(args.target, exist_ok=True)
+
+keys = ['size', 'window', 'mincount', 'sg', 'hs', 'negative', 'cbowmean']
+configs = [dict(zip(keys, values)) for values in itertools.product(*(getattr(args, key) for key in keys))]
+# cbow_mean only matters for CBOW, so Skip-Gram configurations differing only in it are trained once
+configs = [config for config in configs if config['sg'] == 0 or config['cbowmean'] == args.cbowmean[0]]
+names = [model_name(config) for config in configs]
+logging.info('sweeping {} configurations'.format(len(configs)))
+
+# scan the corpus once before the jobs start, so all of them build their vocabulary from the cached word counts
+ids = '--ids' in training_args
+files = training.corpus_files(args.corpora, ids=ids)
+sentences = training.IdCorpusSentences(args.corpora) if ids else training.CorpusSentences(args.corpora)
+scan_model = training.create_model(argparse.Namespace(threads=args.cores, **configs[0]))
+training.build_vocab(scan_model, files, sentences, cache_dir=cache_dir)
+del scan_model
+
+# as many jobs run at the same time as their training threads fit into the core budget
+slots = max(args.cores // args.threads, 1)
+results = {}
+with concurrent.futures.ThreadPoolExecutor(slots) as executor:
+    jobs = {
+        executor.submit(run_job, config, os.path.join(args.target, name + '.model'), args.threads): name
+        for config, name in zip(configs, names)
+    }
+    for job in concurrent.futures.as_completed(jobs):
+        try:
+            results[jobs[job]] = job.result()
+            logging.info('finished {} ({} of {})'.format(jobs[job], len(results), len(configs)))
+        except subprocess.CalledProcessError as e:
+            logging.error('{} failed: {}'.format(jobs[job], e))
+
+# collect all metrics in one table
+table_file = os.path.join(args.target, 'sweep.tsv')
+with open(table_file, 'w') as f:
+    f.write('\t'.join(['model'] + keys + ['seconds', 'words/s'] + METRICS) + '\n')
+    for config, name in zip(configs, names):
+        values = results.get(name, {})
+        row = [name] + [config[key] for key in keys] + [values.get(key, '') for key in ['seconds', 'words/s'] + METRICS]
+        f.write('\t'.join(str(value) for value in row) + '\n')
+logging.info('stored metrics of {} models in {}'.format(len(results), table_file))
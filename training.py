@@ -12,27 +12,659 @@
 # @example: python training.py corpus_dir/ test.model -s 300 -w 10
 
 import gensim
+import numpy as np
+import bz2
+import collections
+import gzip
+import hashlib
+import inspect
+import itertools
+import json
 import logging
 import os
+import queue
+import random
+import shutil
+import sys
+import threading
+import time
 import argparse
 import multiprocessing as mp
 
-# configuration
-parser = argparse.ArgumentParser(description='Script for training word vector models using public corpora')
-parser.add_argument('corpora', type=str, help='source folder with preprocessed corpora (one sentence plain text per line in each file)')
-parser.add_argument('target', type=str, help='target file name to store model in')
-parser.add_argument('-s', '--size', type=int, default=100, help='dimension of word vectors')
-parser.add_argument('-w', '--window', type=int, default=5, help='size of the sliding window')
-parser.add_argument('-m', '--mincount', type=int, default=5, help='minimum number of occurences of a word to be considered')
-parser.add_argument('-t', '--threads', type=int, default=mp.cpu_count(), help='number of worker threads to train the model')
-parser.add_argument('-g', '--sg', type=int, default=1, help='training algorithm: Skip-Gram (1), otherwise CBOW (0)')
-parser.add_argument('-i', '--hs', type=int, default=1, help='use of hierachical sampling for training')
-parser.add_argument('-n', '--negative', type=int, default=0, help='use of negative sampling for training (usually between 5-20)')
-parser.add_argument('-o', '--cbowmean', type=int, default=0, help='for CBOW training algorithm: use sum (0) or mean (1) to merge context vectors')
-args = parser.parse_args()
-logging.basicConfig(
-    filename=args.target.strip() + '.result', format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO
-)
+from corpus import COUNTS_SUFFIX, IDS_SUFFIX, SHARD_PATTERN, corpus_files
+
+
+def mix_sources(dirname, mix):
+    """
+    Groups the corpus files of the given directory into sources by the beginnings of their names.
+
+    :param dirname: corpus directory
+    :param mix: list of file name prefixes with mixing weights, like wiki:2 or news:0.5
+    :return: list of tuples of corpus files and weight, files without a given prefix form a last source of weight 1
+    """
+    rest = corpus_files(dirname)
+    sources = []
+    for source in mix:
+        prefix, _, weight = source.rpartition(':')
+        try:
+            weight = float(weight)
+        except ValueError:
+            raise ValueError('mixing weight of {} is no number'.format(source))
+        # a file belongs to the first source whose prefix it starts with
+        files = [fname for fname in rest if os.path.basename(fname).startswith(prefix)]
+        if not files:
+            raise ValueError('no corpus files starting with {} in {}'.format(prefix, dirname))
+        rest = [fname for fname in rest if fname not in files]
+        sources.append((files, weight))
+    if rest:
+        sources.append((rest, 1.0))
+    return sources
+
+
+def read_counts(counts_file, counts):
+    """
+    Adds the word counts of a counts file to the given counts.
+
+    :param counts_file: file with the sentence count as header and one count and word per line
+    :param counts: Counter to add the word counts to
+    :return: sentence count of the counts file
+    """
+    with open(counts_file, encoding='utf-8') as fp:
+        sentences = int(next(fp).split()[1])
+        for line in fp:
+            count, word = line.rstrip('\n').split(' ', 1)
+            counts[word] += int(count)
+    return sentences
+
+
+def corpus_fingerprint(filenames):
+    """
+    Computes a fingerprint of the given corpus files from their names, sizes, modification times and the
+    first and last bytes of their content, without reading them completely.
+
+    :param filenames: list of corpus files
+    :return: fingerprint as hex str
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for filename in sorted(filenames):
+        stat = os.stat(filename)
+        digest.update('{}\0{}\0{}\0'.format(os.path.basename(filename), stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+        with open(filename, 'rb') as fp:
+            digest.update(fp.read(65536))
+            fp.seek(max(stat.st_size - 65536, 0))
+            digest.update(fp.read(65536))
+    return digest.hexdigest()
+
+
+def save_vocab_cache(cache_file, raw_vocab, sentences):
+    """
+    Stores the raw word counts of a vocabulary scan in the format of the counts files of preprocessing.py.
+
+    :param cache_file: counts file to store the word counts in
+    :param raw_vocab: dict of word counts
+    :param sentences: number of scanned sentences
+    :return: None
+    """
+    try:
+        with open(cache_file + '.tmp', 'w', encoding='utf-8') as f:
+            f.write('# {} sentences\n'.format(sentences))
+            for word, count in sorted(raw_vocab.items(), key=lambda item: -item[1]):
+                f.write('{} {}\n'.format(count, word))
+        os.replace(cache_file + '.tmp', cache_file)
+        logging.info('stored word counts of the vocabulary scan in {}'.format(cache_file))
+    except OSError as e:
+        logging.warning('could not store word counts of the vocabulary scan: {}'.format(e))
+
+
+def load_counts(filenames):
+    """
+    Loads and merges the word counts preprocessing.py stored next to the given corpus files.
+
+    :param filenames: list of corpus files
+    :return: tuple of word counts and sentence count, None if a corpus file has no counts file
+    """
+    counts = collections.Counter()
+    sentences = 0
+    counts_files = []
+    for filename in filenames:
+        counts_file = SHARD_PATTERN.sub('', filename[:-len(IDS_SUFFIX)] if filename.endswith(IDS_SUFFIX) else filename)
+        counts_file += COUNTS_SUFFIX
+        if not os.path.exists(counts_file):
+            return None
+        if counts_file not in counts_files:
+            counts_files.append(counts_file)
+    for counts_file in counts_files:
+        sentences += read_counts(counts_file, counts)
+    return counts, sentences
+
+
+def create_model(args, threads=None):
+    """
+    Creates an untrained gensim Word2Vec model with the hyperparameters of the given arguments.
+
+    :param args: parsed command line arguments of training.py
+    :param threads: number of worker threads, defaults to args.threads
+    :return: gensim Word2Vec model
+    """
+    return gensim.models.Word2Vec(
+        size=args.size,
+        window=args.window,
+        min_count=args.mincount,
+        workers=threads or args.threads,
+        sg=args.sg,
+        hs=args.hs,
+        negative=args.negative,
+        cbow_mean=args.cbowmean,
+        alpha=getattr(args, 'alpha', None) or 0.025,
+        min_alpha=getattr(args, 'min_alpha', None) or 0.0001
+    )
+
+
+def word_vectors(model):
+    """
+    Gets the word vector matrix of the given model, whose rows are in the order of model.wv.index2word.
+
+    :param model: gensim Word2Vec model
+    :return: numpy array of word vectors
+    """
+    # older gensim versions call the matrix syn0
+    return model.wv.vectors if hasattr(model.wv, 'vectors') else model.wv.syn0
+
+
+def trainable_weights(model):
+    """
+    Gets all weight matrices the training of the given model updates: the word vectors and the output weights
+    of hierarchical softmax and negative sampling.
+
+    :param model: gensim Word2Vec model with vocabulary
+    :return: list of numpy arrays
+    """
+    # newer gensim versions keep the output weights in a separate trainables object
+    holder = model.trainables if hasattr(model, 'trainables') else model
+    weights = [word_vectors(model)]
+    if model.hs:
+        weights.append(holder.syn1)
+    if model.negative:
+        weights.append(holder.syn1neg)
+    return weights
+
+
+def export_vectors(model, target, formats, block_size=65536):
+    """
+    Stores the word vectors of the given model in formats downstream tools can use without parsing:
+    a raw .npy matrix, which numpy can memory map, the same matrix with unit length rows and a .vocab file
+    with the corpus count and word of each row in the format of vocabulary.py.
+
+    :param model: gensim Word2Vec model
+    :param target: file name of the model, the exported files are stored next to it
+    :param formats: list of formats to export, vectors, normalized or vocab
+    :param block_size: number of rows normalized at once
+    :return: None
+    """
+    vectors = word_vectors(model)
+    if 'vectors' in formats:
+        np.save(target + '.npy', vectors)
+        logging.info('stored vector matrix of shape {} in {}'.format(vectors.shape, target + '.npy'))
+    if 'normalized' in formats:
+        # normalize block by block into a memory mapped file, so no second copy of the matrix is held in memory
+        normalized = np.lib.format.open_memmap(target + '.normalized.npy', 'w+', vectors.dtype, vectors.shape)
+        for start in range(0, len(vectors), block_size):
+            block = vectors[start:start + block_size]
+            norms = np.linalg.norm(block, axis=1, keepdims=True)
+            normalized[start:start + block_size] = block / np.maximum(norms, np.finfo(vectors.dtype).tiny)
+        normalized.flush()
+        del normalized
+        logging.info('stored normalized vector matrix in {}'.format(target + '.normalized.npy'))
+    if formats:
+        # the rows of the matrices follow the vocabulary, which gensim sorts by descending count
+        with open(target + '.vocab', 'w', encoding='utf-8') as f:
+            for word in model.wv.index2word:
+                f.write('{} {}\n'.format(model.wv.vocab[word].count, word))
+        logging.info('stored vocabulary with corpus counts in {}'.format(target + '.vocab'))
+
+
+def drift_report(model, baseline, report_file, top=50):
+    """
+    Compares the vectors of the words known before continued training with their previous vectors
+    and stores the cosine similarities in a json file.
+
+    :param model: gensim Word2Vec model after continued training
+    :param baseline: word vectors of the known words before continued training
+    :param report_file: file name of the json report
+    :param top: number of most drifted words to report among the 10000 most frequent known words
+    :return: dict of the report
+    """
+    vectors = word_vectors(model)[:len(baseline)]
+    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(baseline, axis=1)
+    similarity = np.einsum('ij,ij->i', vectors, baseline) / np.maximum(norms, 1e-12)
+    frequent = similarity[:10000]
+    report = {
+        'known_words': len(baseline),
+        'new_words': len(model.wv.index2word) - len(baseline),
+        'mean_similarity': float(similarity.mean()),
+        'median_similarity': float(np.median(similarity)),
+        'percentiles': {str(q): float(np.percentile(similarity, q)) for q in (1, 5, 25)},
+        'share_below_0.9': float((similarity < 0.9).mean()),
+        'share_below_0.5': float((similarity < 0.5).mean()),
+        'most_drifted': [
+            [model.wv.index2word[i], float(frequent[i])] for i in np.argsort(frequent)[:top]
+        ]
+    }
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    logging.info('vectors of {} known words drifted to a mean cosine similarity of {:.3f} (median {:.3f}), '
+                 '{:.1%} below 0.9'.format(len(baseline), report['mean_similarity'], report['median_similarity'],
+                                           report['share_below_0.9']))
+    return report
+
+
+def build_vocab_from_counts(model, counts, sentences, update=False):
+    """
+    Builds the vocabulary of the given model from word counts instead of scanning the corpus.
+
+    :param model: untrained gensim Word2Vec model, or a trained one if the vocabulary is updated
+    :param counts: dict of word counts
+    :param sentences: number of sentences the counts were taken from
+    :param update: extend the existing vocabulary of a trained model by the new words
+    :return: None
+    """
+    if hasattr(model, 'build_vocab_from_freq'):
+        model.build_vocab_from_freq(counts, corpus_count=sentences, update=update)
+    else:
+        # older gensim versions only offer the steps following the corpus scan
+        model.raw_vocab = counts
+        model.corpus_count = sentences
+        model.scale_vocab(update=update)
+        model.finalize_vocab(update=update)
+
+
+def supports_corpus_file():
+    """
+    Checks whether the installed gensim can train from a corpus file with its native reader.
+
+    :return: True if Word2Vec accepts a corpus_file
+    """
+    try:
+        from gensim.models import word2vec_corpusfile  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def join_corpus_files(filenames, target):
+    """
+    Gets a single uncompressed corpus file for the given corpus files, since gensim only reads one corpus file.
+
+    :param filenames: list of corpus files
+    :param target: file name to join the corpus files into if necessary
+    :return: tuple of corpus file name and whether it was joined and should be removed after training
+    """
+    if len(filenames) == 1 and not filenames[0].endswith(('.bz2', '.gz')):
+        return filenames[0], False
+    logging.info('joining {} corpus files into {}'.format(len(filenames), target))
+    with open(target, 'wb') as outfile:
+        for fname in filenames:
+            with open_corpus(fname, binary=True) as infile:
+                shutil.copyfileobj(infile, outfile)
+    return target, True
+
+
+def stored_counts(files, cache_dir=None):
+    """
+    Loads the word counts of the given corpus files from the counts files of preprocessing.py if available,
+    otherwise from the cached word counts of an earlier scan of the same corpus.
+
+    :param files: list of corpus files
+    :param cache_dir: folder of the cached word counts
+    :return: tuple of word counts and sentence count, None if neither exists
+    """
+    counts = load_counts(files)
+    if counts:
+        logging.info('building vocabulary from word counts of preprocessing')
+        return counts
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, 'vocab-{}.counts'.format(corpus_fingerprint(files)))
+        if os.path.exists(cache_file):
+            logging.info('building vocabulary from cached word counts {}'.format(cache_file))
+            cached = collections.Counter()
+            return cached, read_counts(cache_file, cached)
+    return None
+
+
+def build_vocab(model, files, sentences=None, corpus_file=None, cache_dir=None, update=False):
+    """
+    Builds the vocabulary of the given model from the counts files of preprocessing.py if available, otherwise from
+    the cached word counts of an earlier scan of the same corpus or a new scan whose word counts are cached.
+    In every case only the min_count trimming and the Huffman tree are computed anew.
+
+    :param model: untrained gensim Word2Vec model, or a trained one if the vocabulary is updated
+    :param files: list of corpus files
+    :param sentences: iterable of corpus sentences to scan
+    :param corpus_file: corpus file to scan instead of the sentences
+    :param cache_dir: folder of the cached word counts, nothing is cached if None
+    :param update: extend the existing vocabulary of a trained model by the new words of the corpus
+    :return: number of words in the corpus
+    """
+    counts = stored_counts(files, cache_dir)
+    if counts:
+        build_vocab_from_counts(model, *counts, update=update)
+        return sum(counts[0].values())
+    if corpus_file:
+        model.build_vocab(corpus_file=corpus_file, keep_raw_vocab=True, update=update)
+    else:
+        model.build_vocab(sentences, keep_raw_vocab=True, update=update)
+    # newer gensim versions keep the raw vocabulary in a separate vocabulary object
+    holder = model.vocabulary if hasattr(model, 'vocabulary') else model
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, 'vocab-{}.counts'.format(corpus_fingerprint(files)))
+        save_vocab_cache(cache_file, holder.raw_vocab, model.corpus_count)
+    total_words = sum(holder.raw_vocab.values())
+    holder.raw_vocab = collections.defaultdict(int)
+    return total_words
+
+
+def mixed_counts(sources, cache_dir=None):
+    """
+    Gets the word counts of several corpus sources, each weighted by how often its sentences are trained per epoch.
+    The counts of a source are taken from counts files or the cache like in build_vocab, otherwise it is scanned
+    and its counts are cached.
+
+    :param sources: list of tuples of corpus files and weight
+    :param cache_dir: folder of the cached word counts, nothing is cached if None
+    :return: tuple of weighted word counts, weighted sentence count and list of the numbers of words of each source
+    """
+    mixed = collections.Counter()
+    mixed_sentences = 0
+    words = []
+    for files, weight in sources:
+        counts = stored_counts(files, cache_dir)
+        if not counts:
+            logging.info('scanning {} corpus files for their word counts'.format(len(files)))
+            scanned = collections.Counter()
+            sentences = 0
+            for fname in files:
+                with open_corpus(fname) as fp:
+                    for line in fp:
+                        scanned.update(line.split())
+                        sentences += 1
+            if cache_dir:
+                cache_file = os.path.join(cache_dir, 'vocab-{}.counts'.format(corpus_fingerprint(files)))
+                save_vocab_cache(cache_file, scanned, sentences)
+            counts = scanned, sentences
+        for word, count in counts[0].items():
+            mixed[word] += count * weight
+        mixed_sentences += counts[1] * weight
+        words.append(sum(counts[0].values()))
+    # sources trained less than once per epoch may leave fractions of counts
+    mixed = collections.Counter({word: int(round(count)) for word, count in mixed.items() if count >= 0.5})
+    return mixed, int(round(mixed_sentences)), words
+
+
+def measure_throughput(model, sentences=None, corpus_file=None, total_words=None, epochs=1, **kwargs):
+    """
+    Trains the given model on sentences or a corpus file and measures the throughput.
+
+    :param model: gensim Word2Vec model with vocabulary
+    :param sentences: iterable of sentences, if no corpus file is given
+    :param corpus_file: plain text corpus file read by gensim's native reader
+    :param total_words: number of words in the corpus
+    :param epochs: number of training epochs
+    :param kwargs: further arguments of gensim's train, like callbacks or compute_loss
+    :return: tuple of seconds and words per second
+    """
+    start = time.perf_counter()
+    if corpus_file:
+        model.train(corpus_file=corpus_file, total_words=total_words, epochs=epochs, **kwargs)
+    else:
+        model.train(sentences, total_examples=model.corpus_count, epochs=epochs, **kwargs)
+    seconds = time.perf_counter() - start
+    return seconds, total_words * epochs / seconds
+
+
+def autotune_threads(model, sentences, corpus_file, candidates, sample_words, target):
+    """
+    Trains fresh models with the vocabulary of the given model briefly on the beginning of the corpus with each of
+    the given thread counts and stores the measured throughputs in a tab separated file.
+
+    :param model: gensim Word2Vec model with vocabulary
+    :param sentences: iterable of sentences, if no corpus file is given
+    :param corpus_file: plain text corpus file read by gensim's native reader
+    :param candidates: list of thread counts to measure
+    :param sample_words: number of words to train with each thread count
+    :param target: file name of the model, the measurements are stored next to it
+    :return: thread count with the highest throughput
+    """
+    sample = None
+    # reading the sample once beforehand spares the first measurement a cold file cache
+    if corpus_file:
+        sample = target + '.autotune.corpus'
+        words = 0
+        with open(corpus_file, 'rb') as fp, open(sample, 'wb') as out:
+            for line in fp:
+                out.write(line)
+                words += len(line.split())
+                if words >= sample_words:
+                    break
+    else:
+        # iterators counting their epochs must not count the measurements
+        epoch = getattr(sentences, 'epoch', None)
+        words = sum(len(sentence) for sentence in EpochSegment(iter(sentences), sample_words))
+    results = []
+    for threads in candidates:
+        trial = create_model(argparse.Namespace(
+            size=model.vector_size, window=model.window, mincount=1, sg=model.sg, hs=model.hs,
+            negative=model.negative, cbowmean=model.cbow_mean
+        ), threads=threads)
+        trial.reset_from(model)
+        start = time.perf_counter()
+        if sample:
+            trial.train(corpus_file=sample, total_words=words, epochs=1)
+        else:
+            trial.train(EpochSegment(iter(sentences), sample_words), total_words=words, epochs=1)
+        seconds = time.perf_counter() - start
+        results.append((threads, seconds, words / seconds))
+        logging.info('autotune: {} threads trained {} words with {:.0f} words/s'.format(
+            threads, words, words / seconds
+        ))
+        del trial
+    if sample:
+        os.remove(sample)
+    elif epoch is not None:
+        sentences.epoch = epoch
+    best = max(results, key=lambda result: result[2])[0]
+    with open(target + '.autotune.tsv', 'w') as f:
+        f.write('threads\tseconds\twords_per_second\tselected\n')
+        for threads, seconds, words_per_second in results:
+            f.write('{}\t{:.1f}\t{:.0f}\t{}\n'.format(threads, seconds, words_per_second, int(threads == best)))
+    return best
+
+
+def training_schedule(model):
+    """
+    Gets the learning rates and number of epochs a model was set up with, which newer gensim versions overwrite
+    with the values of every train call.
+
+    :param model: gensim Word2Vec model before its first train call
+    :return: dict with initial and final learning rate and number of epochs
+    """
+    return {'alpha': model.alpha, 'min_alpha': model.min_alpha, 'epochs': model.iter}
+
+
+def scheduled_alpha(schedule, progress):
+    """
+    Gets the learning rate of the linear decay gensim applies over a whole training run.
+
+    :param schedule: dict with initial and final learning rate and number of epochs
+    :param progress: share of the training done, counted in epochs
+    :return: learning rate
+    """
+    return schedule['alpha'] - (schedule['alpha'] - schedule['min_alpha']) * progress / schedule['epochs']
+
+
+def train_scheduled(model, schedule, start, end, *args, **kwargs):
+    """
+    Trains the given model with the learning rate decaying from one point of a whole training run to another.
+
+    :param model: gensim Word2Vec model with vocabulary
+    :param schedule: dict with initial and final learning rate and number of epochs of the whole training run
+    :param start: share of the training done before, counted in epochs
+    :param end: share of the training done afterwards, counted in epochs
+    :param args: arguments of gensim's train
+    :param kwargs: further keyword arguments of gensim's train
+    :return: None
+    """
+    model.train(
+        *args, start_alpha=scheduled_alpha(schedule, start), end_alpha=scheduled_alpha(schedule, end), **kwargs
+    )
+    # newer gensim versions keep the learning rates and epochs of the last train call
+    model.alpha = schedule['alpha']
+    model.min_alpha = schedule['min_alpha']
+    model.iter = schedule['epochs']
+
+
+def save_checkpoint(model, checkpoint_file, state):
+    """
+    Stores the full trainable state of the given model together with its training progress in a single file.
+
+    :param model: gensim Word2Vec model
+    :param checkpoint_file: file name of the checkpoint
+    :param state: dict with the training progress
+    :return: None
+    """
+    model.checkpoint_state = state
+    # telemetry callbacks hold open files and threads, gensim passes them again with every train call
+    if hasattr(model, 'callbacks'):
+        model.callbacks = ()
+    # storing all arrays in one file makes replacing the previous checkpoint atomic
+    model.save(checkpoint_file + '.tmp', separately=[])
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+    logging.info('stored checkpoint after {} words of epoch {}'.format(state['words'], state['epoch'] + 1))
+
+
+def train_with_checkpoints(model, sentences, corpus_file, total_words, checkpoint_file, epochs=1, words=0, **kwargs):
+    """
+    Trains the given model epoch by epoch or in segments of a given number of words and stores a checkpoint
+    after each of them, continuing from the progress stored in the model by an earlier checkpoint.
+
+    :param model: gensim Word2Vec model with vocabulary
+    :param sentences: iterable of sentences, if no corpus file is given
+    :param corpus_file: plain text corpus file read by gensim's native reader
+    :param total_words: number of words in the corpus
+    :param checkpoint_file: file name of the checkpoint
+    :param epochs: number of epochs between two checkpoints
+    :param words: number of words between two checkpoints, 0 to only store checkpoints between epochs
+    :param kwargs: further arguments of gensim's train, like callbacks or compute_loss
+    :return: tuple of seconds and words per second
+    """
+    state = getattr(model, 'checkpoint_state', None) or {'epoch': 0, 'sentences': 0, 'words': 0}
+    # checkpoints of earlier versions lack the schedule, but their models still hold it
+    schedule = state.setdefault('schedule', training_schedule(model))
+    start = time.perf_counter()
+    trained = 0
+    for epoch in range(state['epoch'], schedule['epochs']):
+        state['epoch'] = epoch
+        pending = False
+        if corpus_file:
+            # gensim reads the corpus file itself, so it can only be interrupted between epochs
+            train_scheduled(
+                model, schedule, epoch, epoch + 1, corpus_file=corpus_file, total_words=total_words, epochs=1, **kwargs
+            )
+            trained += total_words
+        elif not words and not state['sentences']:
+            train_scheduled(
+                model, schedule, epoch, epoch + 1, sentences, total_examples=model.corpus_count, epochs=1, **kwargs
+            )
+            trained += total_words
+        else:
+            iterator = iter(sentences)
+            # sentences trained before the last checkpoint of an interrupted epoch are skipped
+            for _ in itertools.islice(iterator, state['sentences']):
+                pass
+            while True:
+                first = next(iterator, None)
+                if first is None:
+                    break
+                # the checkpoint of a segment is only stored once the epoch goes on, otherwise with the epoch below
+                if pending:
+                    save_checkpoint(model, checkpoint_file, state)
+                # without a word interval the rest of an interrupted epoch is trained in one segment
+                interval = words or total_words
+                remaining = total_words - state['words']
+                size = min(interval, remaining) if remaining > 0 else interval
+                segment = EpochSegment(itertools.chain([first], iterator), size)
+                train_scheduled(
+                    model, schedule, epoch + min(state['words'] / float(total_words), 1),
+                    epoch + min((state['words'] + size) / float(total_words), 1), segment, total_words=size, epochs=1,
+                    **kwargs
+                )
+                trained += segment.words
+                state.update(sentences=state['sentences'] + segment.sentences, words=state['words'] + segment.words)
+                pending = bool(words)
+        state.update(epoch=epoch + 1, sentences=0, words=0)
+        # the final model is stored anyway, so the last epoch needs no checkpoint
+        if (pending or (epoch + 1) % epochs == 0) and epoch + 1 < schedule['epochs']:
+            save_checkpoint(model, checkpoint_file, state)
+    seconds = time.perf_counter() - start
+    return seconds, trained / seconds
+
+
+def open_corpus(fname, binary=False):
+    """
+    Opens a corpus file for reading, decompressing files ending with .bz2 or .gz on the fly.
+
+    :param fname: corpus file
+    :param binary: read bytes instead of str lines
+    :return: file object
+    """
+    mode, encoding = ('rb', None) if binary else ('rt', 'utf-8')
+    if fname.endswith('.bz2'):
+        return bz2.open(fname, mode, encoding=encoding)
+    if fname.endswith('.gz'):
+        return gzip.open(fname, mode, encoding=encoding)
+    return open(fname, mode, encoding=encoding)
+
+
+def read_corpus_files(files, chunks, chunk_size, stop):
+    """
+    Reads the corpus files of the given queue and puts their split sentences in chunks into a bounded queue.
+
+    :param files: queue of corpus files
+    :param chunks: bounded queue to put lists of sentences into, a None is put when no files are left
+        and the exception if reading fails
+    :param chunk_size: number of sentences per chunk
+    :param stop: event telling the reader to give up, set when the consumer stops iterating
+    :return: None
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        while True:
+            try:
+                fname = files.get_nowait()
+            except queue.Empty:
+                break
+            chunk = []
+            with open_corpus(fname) as fp:
+                for line in fp:
+                    chunk.append(line.split())
+                    if len(chunk) == chunk_size:
+                        if not put(chunk):
+                            return
+                        chunk = []
+            if chunk and not put(chunk):
+                return
+    except Exception as e:
+        # the consumer raises the error instead of waiting for the end of this reader forever
+        put(e)
+        return
+    put(None)
 
 
 # get corpus sentences
@@ -41,25 +673,465 @@ class CorpusSentences(object):
         self.dirname = dirname
 
     def __iter__(self):
-        for fname in os.listdir(self.dirname):
-            with open(os.path.join(self.dirname, fname)) as fp:
+        for fname in corpus_files(self.dirname):
+            with open_corpus(fname) as fp:
                 for line in fp:
                     yield line.split()
 
-sentences = CorpusSentences(args.corpora)
-
-# train the model
-model = gensim.models.Word2Vec(
-    sentences,
-    size=args.size,
-    window=args.window,
-    min_count=args.mincount,
-    workers=args.threads,
-    sg=args.sg,
-    hs=args.hs,
-    negative=args.negative,
-    cbow_mean=args.cbowmean
-)
-
-# store model
-model.wv.save_word2vec_format(args.target, binary=True)
+
+# get corpus sentences read and split by background threads, which read several files concurrently
+# file access and decompression release the GIL, so the readers keep up while the training threads run
+class PrefetchingCorpusSentences(object):
+    def __init__(self, dirname, readers, queue_size=64, chunk_size=1024):
+        self.dirname = dirname
+        self.readers = readers
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        files = queue.Queue()
+        for fname in corpus_files(self.dirname):
+            files.put(fname)
+        # the bounded queue keeps the readers at most queue_size chunks ahead of training
+        chunks = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        threads = [
+            threading.Thread(target=read_corpus_files, args=(files, chunks, self.chunk_size, stop), daemon=True)
+            for _ in range(self.readers)
+        ]
+        for thread in threads:
+            thread.start()
+        finished = 0
+        try:
+            while finished < len(threads):
+                chunk = chunks.get()
+                if isinstance(chunk, Exception):
+                    raise chunk
+                if chunk is None:
+                    finished += 1
+                    continue
+                for sentence in chunk:
+                    yield sentence
+        finally:
+            # readers give up if the iteration is abandoned early
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+
+# get interleaved sentences of several corpus sources, each read by its own background threads and trained as often
+# per epoch as its weight says: a weight of 2 repeats every sentence, a weight of 0.5 takes a random half of them
+class MixedCorpusSentences(object):
+    def __init__(self, sources, words, readers=1, queue_size=64, buffer_size=100000, chunk_size=1024, seed=1):
+        self.sources = sources
+        self.words = words
+        self.readers = readers
+        self.queue_size = queue_size
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        # every epoch draws other sentences and another order, but the same ones for the same seed
+        rng = random.Random('{}-{}'.format(self.seed, self.epoch))
+        self.epoch += 1
+        stop = threading.Event()
+        queues = []
+        threads = []
+        for files, _ in self.sources:
+            names = queue.Queue()
+            for fname in files:
+                names.put(fname)
+            chunks = queue.Queue(self.queue_size)
+            queues.append(chunks)
+            threads += [
+                threading.Thread(target=read_corpus_files, args=(names, chunks, self.chunk_size, stop), daemon=True)
+                for _ in range(self.readers)
+            ]
+        for thread in threads:
+            thread.start()
+        # the next chunk comes from a source chosen by its words left to read, so all sources run out at about
+        # the same time and the share of every source stays the same throughout the epoch
+        remaining = list(self.words)
+        finished = [0] * len(self.sources)
+        active = list(range(len(self.sources)))
+        buffer = []
+        try:
+            while active:
+                source = rng.choices(active, [max(remaining[k], 1) for k in active])[0]
+                chunk = queues[source].get()
+                if isinstance(chunk, Exception):
+                    raise chunk
+                if chunk is None:
+                    finished[source] += 1
+                    if finished[source] == self.readers:
+                        active.remove(source)
+                    continue
+                weight = self.sources[source][1]
+                for sentence in chunk:
+                    remaining[source] -= len(sentence)
+                    copies = int(weight) + (rng.random() < weight - int(weight))
+                    for _ in range(copies):
+                        # the shuffle buffer yields a random sentence for each new one once it is full
+                        if len(buffer) < self.buffer_size:
+                            buffer.append(sentence)
+                            continue
+                        k = rng.randrange(self.buffer_size)
+                        yield buffer[k]
+                        buffer[k] = sentence
+            rng.shuffle(buffer)
+            for sentence in buffer:
+                yield sentence
+        finally:
+            # readers give up if the iteration is abandoned early
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+
+# get the sentences of one epoch up to a given number of words, consuming them from an iterator shared by all
+# segments of the epoch
+class EpochSegment(object):
+    def __init__(self, iterator, words):
+        self.iterator = iterator
+        self.limit = words
+        self.words = 0
+        self.sentences = 0
+
+    def __iter__(self):
+        while self.words < self.limit:
+            sentence = next(self.iterator, None)
+            if sentence is None:
+                return
+            self.words += len(sentence)
+            self.sentences += 1
+            yield sentence
+
+
+# record training progress, throughput, learning rate and loss periodically and after every epoch in a JSON lines
+# file and an optional live progress line, it also serves as gensim callback for training from a corpus file
+class Telemetry(object):
+    def __init__(self, model, total_words, metrics_file=None, interval=10.0, progress=False, epoch=0, loss=False):
+        self.model = model
+        # newer gensim versions overwrite the learning rate and epochs of the model with the ones of every train call
+        self.schedule = training_schedule(model)
+        self.epochs = self.schedule['epochs']
+        self.total_words = total_words
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.progress = progress
+        self.epoch = epoch
+        self.loss = loss
+        self.words = 0
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+
+    def trained(self):
+        return self.epoch * self.total_words + min(self.words, self.total_words)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.first = self.trained()
+        self.last = self.epoch_start = (self.started, self.first)
+        self.fp = open(self.metrics_file, 'a') if self.metrics_file else None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            self.record('progress')
+
+    def record(self, event):
+        with self.lock:
+            now = time.perf_counter()
+            trained = self.trained()
+            # periodic records measure the throughput since the last record, epoch records over the whole epoch
+            since, since_trained = self.epoch_start if event == 'epoch' else self.last
+            self.last = (now, trained)
+            total = self.total_words * self.epochs
+            elapsed = now - self.started
+            rate = (trained - self.first) / elapsed if elapsed else 0
+            loss = self.model.get_latest_training_loss() if self.loss else None
+            metrics = collections.OrderedDict([
+                ('event', event), ('time', time.time()), ('elapsed', round(elapsed, 3)),
+                ('epoch', min(self.epoch + 1, self.epochs)), ('words', trained),
+                ('progress', round(trained / float(total), 6)),
+                ('words_per_second', round((trained - since_trained) / (now - since)) if now > since else 0),
+                ('eta', round((total - trained) / rate, 3) if rate else None),
+                # gensim's corpus file mode doesn't track the reached learning rate, so it follows from the schedule
+                ('alpha', round(scheduled_alpha(self.schedule, trained / float(self.total_words)), 6)), ('loss', loss)
+            ])
+            if self.fp:
+                self.fp.write(json.dumps(metrics) + '\n')
+                self.fp.flush()
+            if self.progress:
+                sys.stderr.write('\repoch {}/{} {:6.2%} {:>10} words/s  ETA {:>8}  alpha {}  loss {}   '.format(
+                    metrics['epoch'], self.epochs, metrics['progress'], metrics['words_per_second'],
+                    time.strftime('%H:%M:%S', time.gmtime(metrics['eta'])) if metrics['eta'] is not None else '-',
+                    '{:.6f}'.format(metrics['alpha']),
+                    '{:.4g}'.format(loss) if loss is not None else '-'
+                ))
+                sys.stderr.flush()
+
+    def end_epoch(self):
+        self.words = self.total_words
+        self.record('epoch')
+        with self.lock:
+            self.epoch += 1
+            self.words = 0
+            self.epoch_start = self.last
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+        self.record('end')
+        if self.fp:
+            self.fp.close()
+        if self.progress:
+            sys.stderr.write('\n')
+
+    # gensim callback interface, only the end of an epoch is of interest
+    def on_train_begin(self, model):
+        pass
+
+    def on_train_end(self, model):
+        pass
+
+    def on_epoch_begin(self, model):
+        pass
+
+    def on_epoch_end(self, model):
+        self.end_epoch()
+
+    def on_batch_begin(self, model):
+        pass
+
+    def on_batch_end(self, model):
+        pass
+
+
+# get sentences while counting their words for the telemetry, gensim reads a few jobs ahead of its training
+# threads, so the end of an epoch is recorded shortly before its last sentences are trained
+class MonitoredSentences(object):
+    def __init__(self, sentences, telemetry):
+        self.sentences = sentences
+        self.telemetry = telemetry
+
+    def __iter__(self):
+        for sentence in self.sentences:
+            self.telemetry.words += len(sentence)
+            yield sentence
+        self.telemetry.end_epoch()
+
+
+# get corpus sentences from memory mapped token id corpora
+class IdCorpusSentences(object):
+    def __init__(self, dirname, block_size=65536):
+        self.dirname = dirname
+        self.block_size = block_size
+
+    def __iter__(self):
+        for path in corpus_files(self.dirname, ids=True):
+            with open(path + '.vocab', encoding='utf-8') as fp:
+                vocab = np.array(fp.read().splitlines(), dtype=object)
+            ids = np.memmap(path, dtype=np.uint32, mode='r')
+            offsets = np.memmap(path + '.offsets', dtype=np.uint64, mode='r')
+            # map a whole block of sentences to words at once and slice the sentences from it
+            for first in range(0, len(offsets) - 1, self.block_size):
+                block = offsets[first:first + self.block_size + 1].astype(np.int64)
+                base = block[0]
+                words = vocab[ids[base:block[-1]]].tolist()
+                block = (block - base).tolist()
+                for start, end in zip(block, block[1:]):
+                    yield words[start:end]
+
+
+if __name__ == '__main__':
+    # configuration
+    parser = argparse.ArgumentParser(description='Script for training word vector models using public corpora')
+    parser.add_argument('corpora', type=str, help='source folder with preprocessed corpora (one sentence plain text per line in each file)')
+    parser.add_argument('target', type=str, help='target file name to store model in')
+    parser.add_argument('-s', '--size', type=int, default=100, help='dimension of word vectors')
+    parser.add_argument('-w', '--window', type=int, default=5, help='size of the sliding window')
+    parser.add_argument('-m', '--mincount', type=int, default=5, help='minimum number of occurences of a word to be considered')
+    parser.add_argument('-t', '--threads', type=int, default=mp.cpu_count(), help='number of worker threads to train the model')
+    parser.add_argument('--autotune', action='store_true', help='measure the throughput of several thread counts on a sample of the corpus first and train with the fastest one')
+    parser.add_argument('--autotune_threads', type=int, nargs='+', help='thread counts measured by --autotune (default: all cores, 1 or 2 less, 3/4, 1/2 and 1/4 of them)')
+    parser.add_argument('--autotune_words', type=int, default=5000000, help='number of words of the sample every thread count of --autotune is trained on')
+    parser.add_argument('-g', '--sg', type=int, default=1, help='training algorithm: Skip-Gram (1), otherwise CBOW (0)')
+    parser.add_argument('-i', '--hs', type=int, default=1, help='use of hierachical sampling for training')
+    parser.add_argument('-n', '--negative', type=int, default=0, help='use of negative sampling for training (usually between 5-20)')
+    parser.add_argument('--ids', action='store_true', help='train on the binary token id corpora written by preprocessing.py --ids')
+    parser.add_argument('-r', '--readers', type=int, default=0, help='number of background threads reading corpus files concurrently (0 reads in the main thread)')
+    parser.add_argument('--prefetch', type=int, default=64, help='maximum number of sentence chunks of 1024 sentences the readers keep ready')
+    parser.add_argument('--mix', type=str, nargs='+', help='train on the corpus files grouped by name prefix into sources with mixing weights, like wiki:2 news:0.5 (other files have weight 1)')
+    parser.add_argument('--shuffle_buffer', type=int, default=100000, help='number of sentences the shuffle buffer of --mix interleaves the sources in')
+    parser.add_argument('-f', '--corpus_file', action='store_true', help='let the training threads read the corpus file themselves in native code, if the installed gensim supports it')
+    parser.add_argument('--vocab_cache', type=str, help='folder to cache the word counts of vocabulary scans in, keyed by corpus fingerprint (default: the corpus folder)')
+    parser.add_argument('--checkpoint_epochs', type=int, default=0, help='store a checkpoint of the model every given number of epochs')
+    parser.add_argument('--checkpoint_words', type=int, default=0, help='store a checkpoint of the model every given number of words')
+    parser.add_argument('--resume', action='store_true', help='continue an interrupted training from its last checkpoint')
+    parser.add_argument('--update', type=str, help='continue training a full model stored with --full on the given corpora, extending its vocabulary')
+    parser.add_argument('-a', '--alpha', type=float, help='initial learning rate (default: 0.025, or the one of the model given by --update)')
+    parser.add_argument('--min_alpha', type=float, help='final learning rate (default: 0.0001, or the one of the model given by --update)')
+    parser.add_argument('--full', action='store_true', help='additionally store the full model for continued training in a .full file')
+    parser.add_argument('-e', '--export', type=str, nargs='+', default=[], choices=['vectors', 'normalized', 'vocab'], help='additionally store the vectors as .npy matrix, normalized as .normalized.npy matrix and/or the vocabulary with corpus counts as .vocab file')
+    parser.add_argument('--metrics', action='store_true', help='record throughput, ETA, learning rate and training loss in a .metrics.jsonl file')
+    parser.add_argument('--metrics_interval', type=float, default=10.0, help='seconds between two periodic records of --metrics and --progress')
+    parser.add_argument('--progress', action='store_true', help='show a live progress line with the current metrics on stderr')
+    parser.add_argument('-o', '--cbowmean', type=int, default=0, help='for CBOW training algorithm: use sum (0) or mean (1) to merge context vectors')
+    args = parser.parse_args()
+    logging.basicConfig(
+        filename=args.target.strip() + '.result', format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO
+    )
+
+    # in corpus file mode every training thread reads its own part of the corpus file without the python iterator
+    files = corpus_files(args.corpora, ids=args.ids)
+    corpus_file = None
+    joined = False
+    if args.corpus_file:
+        if args.ids:
+            sys.exit('--corpus_file reads plain text corpora and cannot be combined with --ids')
+        if supports_corpus_file():
+            corpus_file, joined = join_corpus_files(files, args.target.strip() + '.corpus')
+        else:
+            logging.warning('installed gensim cannot train from a corpus file, falling back to the sentence iterator')
+    mixed = None
+    if args.mix:
+        # mixed sources are read by their own readers, their word counts are weighted for the vocabulary
+        if args.ids or args.corpus_file:
+            sys.exit('--mix reads plain text corpora with the sentence iterator and cannot be combined with --ids '
+                     'or --corpus_file')
+        try:
+            sources = mix_sources(args.corpora, args.mix)
+        except ValueError as e:
+            sys.exit(str(e))
+        for source_files, weight in sources:
+            logging.info('mixing {} corpus files with weight {}'.format(len(source_files), weight))
+        mixed = mixed_counts(sources, args.vocab_cache or args.corpora)
+        sentences = MixedCorpusSentences(sources, mixed[2], max(args.readers, 1), args.prefetch, args.shuffle_buffer)
+    elif args.ids:
+        sentences = IdCorpusSentences(args.corpora)
+    elif args.readers:
+        sentences = PrefetchingCorpusSentences(args.corpora, args.readers, args.prefetch)
+    else:
+        sentences = CorpusSentences(args.corpora)
+
+    # a checkpoint holds the full model and how far the learning rate schedule got
+    checkpoint_file = args.target.strip() + '.checkpoint'
+    options = {key: getattr(args, key) for key in ['size', 'window', 'mincount', 'sg', 'hs', 'negative', 'cbowmean']}
+    options['corpora'] = os.path.abspath(args.corpora)
+    if args.mix:
+        options['mix'] = args.mix
+    resumed = args.resume and os.path.exists(checkpoint_file)
+    baseline = None
+    if resumed:
+        model = gensim.models.Word2Vec.load(checkpoint_file)
+        if model.checkpoint_state['options'] != options:
+            sys.exit('checkpoint {} belongs to a different corpus or options'.format(checkpoint_file))
+        model.workers = args.threads
+        total_words = model.checkpoint_state['total_words']
+        if mixed:
+            # the interrupted epoch continues with the same draws of sentences
+            sentences.epoch = model.checkpoint_state['epoch']
+        logging.info('resuming after {} words of epoch {}'.format(
+            model.checkpoint_state['words'], model.checkpoint_state['epoch'] + 1
+        ))
+        if args.update:
+            logging.warning('vectors before the update are not part of the checkpoint, so no drift is reported')
+        if args.readers > 1 and model.checkpoint_state['sentences']:
+            logging.warning('several readers return sentences in varying order, so the rest of the interrupted epoch '
+                            'skips as many sentences as were trained, but not exactly the same ones')
+    else:
+        if args.resume:
+            logging.warning('no checkpoint found, starting from the beginning')
+        if args.update:
+            # continue training a full model on new corpora, keeping the vectors of known words as a baseline
+            model = gensim.models.Word2Vec.load(args.update)
+            model.workers = args.threads
+            model.alpha = args.alpha or model.alpha
+            model.min_alpha = args.min_alpha or model.min_alpha
+            baseline = word_vectors(model).copy()
+            if mixed:
+                build_vocab_from_counts(model, mixed[0], mixed[1], update=True)
+                total_words = sum(mixed[0].values())
+            else:
+                total_words = build_vocab(model, files, sentences, corpus_file, args.vocab_cache or args.corpora, True)
+            logging.info('extended vocabulary of {} words by {} new words'.format(
+                len(baseline), len(model.wv.index2word) - len(baseline)
+            ))
+            if model.hs:
+                logging.warning('hierarchical softmax builds a new Huffman tree for the extended vocabulary, '
+                                'so the output weights of known words get new positions in the tree')
+        else:
+            # train the model
+            model = create_model(args)
+            if mixed:
+                build_vocab_from_counts(model, mixed[0], mixed[1])
+                total_words = sum(mixed[0].values())
+            else:
+                total_words = build_vocab(model, files, sentences, corpus_file, args.vocab_cache or args.corpora)
+    if args.autotune:
+        cores = mp.cpu_count()
+        candidates = sorted(set(args.autotune_threads or [
+            threads for threads in [cores, cores - 1, cores - 2, cores * 3 // 4, cores // 2, cores // 4] if threads > 0
+        ]))
+        model.workers = autotune_threads(
+            model, sentences, corpus_file, candidates, args.autotune_words, args.target.strip()
+        )
+        logging.info('autotune selected {} threads'.format(model.workers))
+    # telemetry counts the words handed to gensim, in corpus file mode only the finished epochs via gensim's callbacks
+    train_args = {}
+    telemetry = None
+    if args.metrics or args.progress:
+        # older gensim versions cannot compute the training loss
+        if 'compute_loss' in inspect.signature(model.train).parameters:
+            train_args['compute_loss'] = True
+        telemetry = Telemetry(
+            model, total_words, args.target.strip() + '.metrics.jsonl' if args.metrics else None, args.metrics_interval,
+            args.progress, model.checkpoint_state['epoch'] if resumed else 0, 'compute_loss' in train_args
+        )
+        if corpus_file:
+            train_args['callbacks'] = [telemetry]
+        else:
+            sentences = MonitoredSentences(sentences, telemetry)
+        telemetry.start()
+    if resumed or args.checkpoint_epochs or args.checkpoint_words:
+        if not resumed:
+            model.checkpoint_state = {
+                'epoch': 0, 'sentences': 0, 'words': 0, 'total_words': total_words, 'options': options,
+                'schedule': training_schedule(model)
+            }
+        if args.checkpoint_words and corpus_file:
+            logging.warning('checkpoints in corpus file mode are only stored between epochs')
+        seconds, words_per_second = train_with_checkpoints(
+            model, sentences, corpus_file, total_words, checkpoint_file, args.checkpoint_epochs or 1,
+            args.checkpoint_words, **train_args
+        )
+        del model.checkpoint_state
+    else:
+        seconds, words_per_second = measure_throughput(
+            model, sentences, corpus_file, total_words, epochs=model.iter, **train_args
+        )
+    if telemetry:
+        telemetry.close()
+        if hasattr(model, 'callbacks'):
+            model.callbacks = ()
+    logging.info('trained {} epochs in {:.0f} seconds with {:.0f} words/s'.format(
+        model.iter, seconds, words_per_second
+    ))
+    if joined:
+        os.remove(corpus_file)
+
+    if baseline is not None:
+        drift_report(model, baseline, args.target.strip() + '.drift.json')
+
+    # store model
+    model.wv.save_word2vec_format(args.target, binary=True)
+    export_vectors(model, args.target.strip(), args.export)
+    if args.full:
+        model.save(args.target.strip() + '.full')
+    # the training is complete, so there is nothing left to resume
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
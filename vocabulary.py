@@ -11,24 +11,111 @@
 #
 # @example: python vocabulary.py test.model test.model.vocab
 
-import gensim
 import argparse
+import functools
+import heapq
+import logging
+import os
+import sys
+
+
+def binary_words(model_file, window=64):
+    """
+    Reads the words of a binary word2vec model without its vectors. gensim stores the words by descending count,
+    but not the counts themselves, so like gensim's loader the vocabulary size minus the position is used as count.
+
+    :param model_file: binary word2vec model
+    :param window: number of bytes read at once to find the end of a word
+    :return: generator of tuples of count and word
+    """
+    with open(model_file, 'rb') as fp:
+        vocab_size, vector_size = (int(value) for value in fp.readline().split())
+        position = fp.tell()
+    # only a few bytes around each word are read, every vector is skipped by its length of float32 values
+    with open(model_file, 'rb', buffering=0) as fp:
+        for index in range(vocab_size):
+            fp.seek(position)
+            data = fp.read(window)
+            end = data.find(b' ')
+            while end < 0:
+                more = fp.read(window)
+                if not more:
+                    raise ValueError('{} ends after {} of {} words'.format(model_file, index, vocab_size))
+                data += more
+                end = data.find(b' ')
+            # the original word2vec tool ends every vector with a newline, gensim doesn't
+            yield vocab_size - index, data[:end].lstrip(b'\n').decode('utf-8')
+            position += end + 1 + vector_size * 4
+
+
+def counts_words(counts_file):
+    """
+    Reads the words of a counts file with one count and word per line, like the .vocab files of training.py --export
+    or the .counts files of preprocessing.py.
+
+    :param counts_file: counts file
+    :return: generator of tuples of count and word
+    """
+    with open(counts_file, encoding='utf-8') as fp:
+        for line in fp:
+            # the sentence count header of preprocessing.py
+            if line.startswith('# '):
+                continue
+            count, word = line.rstrip('\n').split(' ', 1)
+            yield int(count), word
+
+
+def is_sorted(words):
+    """
+    Checks whether the given words are sorted by descending count.
+
+    :param words: iterable of tuples of count and word
+    :return: True if no count is higher than the one before
+    """
+    previous = float('inf')
+    for count, _ in words:
+        if count > previous:
+            return False
+        previous = count
+    return True
+
 
 # configuration
 parser = argparse.ArgumentParser(description='Script for computing vocabulary of given corpus')
 parser.add_argument('model', type=str, help='source file with trained model')
 parser.add_argument('target', type=str, help='target file name to store vocabulary in')
+parser.add_argument('-k', '--top', type=int, help='only store the given number of most frequent words')
+parser.add_argument(
+    '-c', '--counts', type=str,
+    help='counts file to take the words and their corpus counts from, like the .vocab file of training.py --export'
+)
 args = parser.parse_args()
+logging.basicConfig(stream=sys.stdout, format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 
-# load model
-model = gensim.models.KeyedVectors.load_word2vec_format(args.model, binary=True)
+# a counts file like the vocabulary file of training.py --export has the true corpus counts, the binary model only
+# the order of the words
+counts_file = args.counts
+if counts_file:
+    logging.info('reading words and corpus counts from {}'.format(counts_file))
+    read_words = functools.partial(counts_words, counts_file)
+else:
+    logging.info('reading words of {} without its vectors'.format(args.model))
+    read_words = functools.partial(binary_words, args.model)
 
-# build vocab
-vocab = []
-for word, obj in model.vocab.items():
-    vocab.append([word, obj.count])
+# the words of a model are usually sorted already and streamed in constant memory, a top k list is kept in a heap
+if args.top:
+    vocab = heapq.nlargest(args.top, read_words(), key=lambda item: item[0])
+elif counts_file and not is_sorted(read_words()):
+    logging.info('{} is not sorted by count, sorting it in memory'.format(counts_file))
+    vocab = sorted(read_words(), key=lambda item: item[0], reverse=True)
+else:
+    vocab = read_words()
 
-# save vocab
-with open(args.target, 'w') as f:
-    for word, count in sorted(vocab, key=lambda x: x[1], reverse=True):
+# save vocab, the target may be the counts file itself
+words = 0
+with open(args.target + '.tmp', 'w', encoding='utf-8') as f:
+    for count, word in vocab:
         f.write('{} {}\n'.format(count, word))
+        words += 1
+os.replace(args.target + '.tmp', args.target)
+logging.info('stored {} words in {}'.format(words, args.target))
@@ -15,6 +15,7 @@ printf "done!\n"
 # get scripts
 printf "Downloading scripts... "
 wget -q https://raw.githubusercontent.com/devmount/GermanWordEmbeddings/master/preprocessing.py
+wget -q https://raw.githubusercontent.com/devmount/GermanWordEmbeddings/master/corpus.py
 wget -q https://raw.githubusercontent.com/devmount/GermanWordEmbeddings/master/training.py
 wget -q https://raw.githubusercontent.com/devmount/GermanWordEmbeddings/master/evaluation.py
 printf "done!\n"
@@ -42,14 +43,10 @@ printf "Downloading and preprocessing wikipedia raw data... "
 wget http://download.wikimedia.org/dewiki/latest/dewiki-latest-pages-articles.xml.bz2
 wget http://medialab.di.unipi.it/Project/SemaWiki/Tools/WikiExtractor.py
 python WikiExtractor.py -c -b 25M -o extracted dewiki-latest-pages-articles.xml.bz2
-find extracted -name '*bz2' \! -exec bzip2 -k -c -d {} \; > dewiki.xml
-printf "Number of articles: "
-grep -o "<doc" dewiki.xml | wc -w
-sed -i 's/<[^>]*>//g' dewiki.xml
-rm -rf extracted
-python preprocessing.py dewiki.xml corpus/dewiki.corpus -psub
+# preprocessing.py reads the extracted shards directly and logs the number of articles
+python preprocessing.py extracted corpus/dewiki.corpus -psub
 printf "done!\n"
-rm dewiki.xml
+rm -rf extracted
 # only keep .bigram corpus files (preprocessing.py -b creates additional .bigram files to normal .corpus files)
 rm corpus/*.corpus
 